@@ -2,14 +2,22 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 import os
+import io
 import logging
 import re
 import json
 import asyncio
 import time
+import heapq
+import bisect
+import itertools
 import datetime
-import aiofiles
-from github import Github
+import signal
+import sqlite3
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from github import Github, UnknownObjectException
 from discord.ext import commands, tasks
 from discord import app_commands, ui, Interaction, Embed
 
@@ -28,35 +36,1032 @@ intents = discord.Intents.all()
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class DKPBot(commands.Bot):
+    async def setup_hook(self):
+        """Загружает DKP в память и запускает фоновый сброс на диск."""
+        global dkp_data, dkp_log_index, last_auction_id
+        if DKP_STORAGE == "sqlite":
+            open_dkp_db()
+            dkp_data = read_dkp_db()
+            last_auction_id = db_last_auction_id()
+        else:
+            dkp_data = read_dkp_file()
+            # Падение посреди перезаписи лога оставляет только dkp_log.jsonl.bak - возвращаем его,
+            # иначе лог был бы заново собран из устаревшего dkp_log.json
+            restore_file_backup(DKP_EVENTS_FILE)
+            # Старый dkp_log.json переводим в dkp_log.jsonl один раз
+            if not os.path.exists(DKP_EVENTS_FILE) and os.path.exists(DKP_LOG_FILE):
+                convert_dkp_log_to_jsonl()
+            # Доигрываем транзакции, которые не успели попасть в dkp_data.json до остановки
+            if recover_dkp_wal(dkp_data):
+                write_dkp_file(dkp_data)
+                os.remove(DKP_WAL_FILE)
+            dkp_log_index = build_dkp_log_index()
+            # Старые записи со строковыми метками времени переводим в epoch один раз
+            if dkp_log_index.legacy:
+                migrate_dkp_log_timestamps()
+                dkp_log_index = build_dkp_log_index()
+            last_auction_id = int(load_auction_history().log["last_id"])
+        load_dkp_checkpoints()
+        leaderboard.rebuild(dkp_data)
+        # Активные аукционы восстанавливаем до on_ready, таймеры ставятся заново
+        restore_auctions_state()
+        # Кнопки страниц живут и после рестарта: маршрут зашит в custom_id
+        self.add_dynamic_items(PageButton)
+        dkp_flush_loop.start()
+        auction_snapshot_loop.start()
+        self.loop.create_task(auction_scheduler())
+        self.loop.create_task(auction_board_loop())
+        self.loop.create_task(ledger_writer())
+        self.loop.create_task(monitor_loop_lag())
+        # Procfile-деплой останавливает процесс через SIGTERM - успеваем сохранить данные
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows не поддерживает add_signal_handler
+
+    async def close(self):
+        """Сбрасывает несохраненные DKP и активные аукционы на диск перед выходом."""
+        if self.is_closed():
+            return
+        dkp_flush_loop.cancel()
+        auction_snapshot_loop.cancel()
+        # Дожидаемся, пока писатель DKP сохранит все изменения из очереди
+        await ledger_queue.join()
+        await flush_dkp_data()
+        await flush_auctions_state()
+        # Даем очереди исходящих сообщений отправить то, что уже поставлено
+        await outbox.drain(timeout=10)
+        if db_conn is not None:
+            await run_io(db_conn.close)
+        io_executor.shutdown(wait=True)
+        await super().close()
+
+bot = DKPBot(command_prefix="!", intents=intents)
 
 # Путь к файлу, где будут храниться данные
 DKP_FILE = "dkp_data.json"
+DKP_LOG_FILE = "dkp_log.json"
+# Лог DKP: по одной JSON-записи на строку, новые записи только дописываются в конец
+DKP_EVENTS_FILE = "dkp_log.jsonl"
+dkp_log_lock = asyncio.Lock()
+# Записи, уже сохраненные в журнале транзакций, но не дописанные в лог (ошибка записи) - допишутся со следующими
+dkp_log_backlog = []
+# Индекс лога (DkpLogIndex): смещения строк, метки времени и последние записи по пользователям
+dkp_log_index = None
+DKP_LOG_PAGE_SIZE = 10
+# Метки времени в истории хранятся целыми секундами epoch, в текст переводятся только при выводе
+LOG_TIME_FORMAT = "[%Y-%m-%d %H:%M:%S]"
+# Контрольные точки балансов: баланс на дату = ближайшая точка + доигрывание лога после нее.
+# Новая точка пишется после DKP_CHECKPOINT_EVENTS записей лога или раз в DKP_CHECKPOINT_INTERVAL секунд
+DKP_CHECKPOINTS_FILE = "dkp_checkpoints.jsonl"
+DKP_CHECKPOINT_EVENTS = int(os.environ.get('DKP_CHECKPOINT_EVENTS', 500))
+DKP_CHECKPOINT_INTERVAL = float(os.environ.get('DKP_CHECKPOINT_INTERVAL', 86400))
+dkp_checkpoints = []  # [(timestamp, смещение строки в DKP_CHECKPOINTS_FILE)], только JSON-хранилище
+checkpoint_state = {"timestamp": 0, "events": 0}  # Последняя точка и число записей лога после нее
+# Журнал транзакций DKP: изменения, еще не сброшенные в dkp_data.json (очищается при каждом сбросе)
+DKP_WAL_FILE = "dkp_data.wal"
+# Хранилище: "json" (файлы выше) или "sqlite" (база DKP_DB_FILE, перенос данных - !migrate_sqlite)
+DKP_STORAGE = os.environ.get('DKP_STORAGE', 'json').lower()
+DKP_DB_FILE = os.environ.get('DKP_DB_FILE', 'dkp.db')
+db_conn = None
+# Как часто (в секундах) несохраненные DKP сбрасываются на диск
+DKP_FLUSH_INTERVAL = float(os.environ.get('DKP_FLUSH_INTERVAL', 30))
+# Общая блокировка нужна только для согласованного снимка всех балансов (сброс на диск);
+# изменения балансов защищаются блокировками участников (lock_members)
 dkp_lock = asyncio.Lock()
+# Блокировки участников разбиты на полосы: участник попадает в полосу по своему ID
+DKP_LOCK_STRIPES = int(os.environ.get('DKP_LOCK_STRIPES', 64))
+member_locks = [asyncio.Lock() for _ in range(DKP_LOCK_STRIPES)]
+# DKP держим в памяти: файл читается один раз при старте, дальше только сбросы на диск
+dkp_data = {}
+dkp_dirty = False
 auctions = {}
 AUC_LOG_FILE = "auc_log.json"
+# Последний выданный ID аукциона: читается один раз при старте, дальше выдается из памяти
+last_auction_id = 0
 # Словарь для хранения ID сообщений об аукционах
 auction_messages = {}
 # Храним время последних ставок: {auction_id: {user_id: timestamp}}
 last_bid_times = {}
 # Храним время последнего удаления ставки (ключ - user_id)
 last_dbid_times = {}
+# Снимок активных аукционов (auctions, auction_messages, last_bid_times) для восстановления после рестарта
+AUCTIONS_STATE_FILE = "active_auctions.json"
+AUCTION_SNAPSHOT_INTERVAL = float(os.environ.get('AUCTION_SNAPSHOT_INTERVAL', 2))
+auctions_dirty = False
+# Кэш пользователей, которых пришлось запросить через API (ушли с сервера и т. п.)
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 3600))
+user_cache = OrderedDict()  # {user_id: (expires_at, user)}
+# Заблокированные ставками DKP: {user_id: {auction_id: amount}} и итог по пользователю
+bid_holds = {}
+locked_dkp_totals = {}
+# Планировщик завершения аукционов: куча (end_time, auction_id) и одна фоновая задача
+auction_heap = []
+auction_wakeup = asyncio.Event()
+# Насколько позже end_time реально завершаются аукционы (секунды)
+settle_lag_stats = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+# Живая доска аукционов: одно сообщение в BIDS_CHANNEL на сервер, редактируется на месте
+# не чаще BOARD_EDITS_PER_SECOND раз в секунду, сколько бы ставок ни пришло
+BOARD_EDITS_PER_SECOND = float(os.environ.get('BOARD_EDITS_PER_SECOND', 1))
+board_messages = {}  # {guild_id: message_id}
+board_dirty = set()  # guild_id досок, которые надо перерисовать
+board_wakeup = asyncio.Event()
 # Список доступных ролей
-AVAILABLE_ROLES = ["Tank", "DD", "Healer"]
+AVAILABLE_ROLES = [role.strip() for role in os.environ.get('AVAILABLE_ROLES', 'Tank,DD,Healer').split(",") if role.strip()]
+# Каналы, с которыми работает бот
+BIDS_CHANNEL = os.environ.get('BIDS_CHANNEL', '💰bidschannel💰')
+LIVE_AUCTIONS_CHANNEL = os.environ.get('LIVE_AUCTIONS_CHANNEL', '📢liveauctions📢')
+RESULTS_CHANNEL = os.environ.get('RESULTS_CHANNEL', '🏆auctionsresult🏆')
+# Реестр каналов и ролей по имени: {guild_id: {name: id}}, обновляется событиями гильдии
+channel_registry = {}
+role_registry = {}
+
+# Файлы, SQLite и сериализация JSON работают в отдельном потоке, event loop их не ждет.
+# Поток один - операции с диском выполняются строго по очереди.
+io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dkp-io")
+# Замеры: время в потоке ввода-вывода, время снимков данных на loop и задержка самого loop (секунды)
+io_stats = {"calls": 0, "io_total": 0.0, "io_max": 0.0, "snapshot_max": 0.0, "loop_lag_max": 0.0, "loop_lag_last": 0.0}
+LOOP_LAG_WARNING = float(os.environ.get('LOOP_LAG_WARNING', 0.25))
+
+async def run_io(func, *args):
+    """Выполняет func(*args) в потоке ввода-вывода и возвращает результат."""
+    started = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+    elapsed = time.perf_counter() - started
+    io_stats["calls"] += 1
+    io_stats["io_total"] += elapsed
+    io_stats["io_max"] = max(io_stats["io_max"], elapsed)
+    return result
+
+def record_snapshot_time(started):
+    """Учитывает, сколько loop был занят копированием данных перед записью."""
+    io_stats["snapshot_max"] = max(io_stats["snapshot_max"], time.perf_counter() - started)
+
+async def monitor_loop_lag(interval=0.5):
+    """Замеряет, на сколько loop опаздывает разбудить задачу - это и есть время его блокировки."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - started - interval
+        io_stats["loop_lag_last"] = lag
+        io_stats["loop_lag_max"] = max(io_stats["loop_lag_max"], lag)
+        if lag > LOOP_LAG_WARNING:
+            print(f"[WARN] Event loop был заблокирован на {lag:.3f}s")
+
+def write_file_atomic(path, content):
+    """Надежная запись файла: временный файл -> fsync -> атомарная замена.
+
+    Предыдущая версия остается в path + ".bak". При падении на любом шаге на диске
+    остается либо старый, либо новый файл целиком (в худшем случае - только .bak)."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(path):
+        os.replace(path, path + ".bak")
+    os.replace(tmp_file, path)
+    # Фиксируем переименование в каталоге (на Windows не поддерживается)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+def restore_file_backup(path):
+    """Если файла нет, а его копия .bak осталась (падение между переименованиями в write_file_atomic),
+    возвращает копию на место."""
+    if not os.path.exists(path) and os.path.exists(path + ".bak"):
+        os.replace(path + ".bak", path)
+        print(f"[WARN] {path} не найден, восстановлен из резервной копии {path}.bak")
+        return True
+    return False
+
+def fsync_file(path):
+    """Дожидается записи на диск всего, что уже дописано в файл."""
+    try:
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+    except FileNotFoundError:
+        pass
+
+def read_json_checked(path, default):
+    """Читает JSON-файл, проверяя целостность. Пустой или битый файл заменяется последней копией из .bak."""
+    for candidate in (path, path + ".bak"):
+        try:
+            with open(candidate, "r", encoding="utf-8") as f:
+                data = json.loads(f.read())
+        except FileNotFoundError:
+            continue
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"[ERROR] Файл {candidate} поврежден: {e}")
+            continue
+        if not isinstance(data, type(default)):
+            print(f"[ERROR] Файл {candidate} поврежден: неожиданный формат")
+            continue
+        if candidate != path:
+            print(f"[WARN] {path} не прочитан, используем резервную копию {candidate}")
+        return data
+    return default
+
+def read_dkp_file():
+    return read_json_checked(DKP_FILE, {})
+
+def write_dkp_file(data):
+    write_file_atomic(DKP_FILE, json.dumps(data, indent=4))
 
 async def load_dkp_data():
-    async with dkp_lock:
-        try:
-            with open(DKP_FILE, "r") as f:
-                data = f.read().strip()
-                return json.loads(data) if data else {}
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+    """Возвращает DKP из памяти, без чтения файла."""
+    return dkp_data
 
 async def save_dkp_data(data):
+    """Помечает DKP как измененные, на диск их запишет dkp_flush_loop."""
+    global dkp_data, dkp_dirty
+    dkp_data = data
+    dkp_dirty = True
+
+def write_dkp_snapshot(snapshot):
+    if DKP_STORAGE == "sqlite":
+        write_dkp_db(snapshot)
+    else:
+        write_dkp_file(snapshot)
+        # Все транзакции из журнала теперь есть в dkp_data.json; пока есть недописанные
+        # в лог записи, журнал оставляем - при старте он их допишет
+        if os.path.exists(DKP_WAL_FILE) and not dkp_log_backlog:
+            # Лог дописывается без fsync - журнал единственная надежная копия его новых записей,
+            # поэтому удаляем журнал только после того, как лог на диске
+            fsync_file(DKP_EVENTS_FILE)
+            os.remove(DKP_WAL_FILE)
+
+async def flush_dkp_data():
+    """Записывает DKP на диск, если с последнего сброса были изменения."""
+    global dkp_dirty
     async with dkp_lock:
-        with open(DKP_FILE, "w") as f:
-            json.dump(data, f, indent=4)
+        if not dkp_dirty:
+            return
+        # На loop только копируем балансы, сериализация и запись - в потоке ввода-вывода
+        started = time.perf_counter()
+        snapshot = {user_id: dict(user_data) for user_id, user_data in dkp_data.items()}
+        record_snapshot_time(started)
+        dkp_dirty = False
+        try:
+            await run_io(write_dkp_snapshot, snapshot)
+        except Exception:
+            dkp_dirty = True  # Повторим при следующем сбросе
+            raise
+
+@tasks.loop(seconds=DKP_FLUSH_INTERVAL)
+async def dkp_flush_loop():
+    await flush_dkp_data()
+
+def to_epoch(value):
+    """Метка времени в целых секундах epoch; старые строки "[YYYY-MM-DD HH:MM:SS]" (местное время) переводятся."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return int(time.mktime(time.strptime(value, LOG_TIME_FORMAT)))
+    return int(value)
+
+def format_timestamp(value):
+    return time.strftime(LOG_TIME_FORMAT, time.localtime(to_epoch(value)))
+
+def parse_date_range(date_from=None, date_to=None):
+    """Даты YYYY-MM-DD (местное время) в границы epoch: с начала date_from до конца date_to.
+    ValueError, если дата в другом формате."""
+    start = int(time.mktime(time.strptime(date_from, "%Y-%m-%d"))) if date_from else None
+    end = int(time.mktime(time.strptime(date_to, "%Y-%m-%d"))) + 86399 if date_to else None
+    return start, end
+
+class DkpLogIndex:
+    """Индекс dkp_log.jsonl в памяти.
+
+    По каждому пользователю: смещения его строк в файле и их метки времени (по порядку,
+    как записи в файле), поэтому записи за период находятся бинарным поиском без чтения
+    файла; плюс последние DKP_LOG_PAGE_SIZE записей для первой страницы !log."""
+
+    def __init__(self):
+        self.offsets = {}  # {user_id: [смещение строки]}
+        self.times = {}  # {user_id: [timestamp]}
+        self.recent = {}  # {user_id: deque(maxlen=DKP_LOG_PAGE_SIZE)}
+        self.legacy = 0  # Записи со строковыми метками времени (до перевода в epoch)
+
+    def add(self, entry, offset):
+        user_id = entry["user_id"]
+        if isinstance(entry["timestamp"], str):
+            self.legacy += 1
+        self.offsets.setdefault(user_id, []).append(offset)
+        self.times.setdefault(user_id, []).append(to_epoch(entry["timestamp"]))
+        self.recent.setdefault(user_id, deque(maxlen=DKP_LOG_PAGE_SIZE)).append(entry)
+
+    def range(self, user_id, start=None, end=None):
+        """(lo, hi): записи пользователя с номерами lo..hi-1 попадают в start <= timestamp <= end."""
+        times = self.times.get(user_id, [])
+        lo = bisect.bisect_left(times, start) if start is not None else 0
+        hi = bisect.bisect_right(times, end) if end is not None else len(times)
+        return lo, max(lo, hi)
+
+    def page(self, user_id, page, start=None, end=None):
+        """Смещения строк страницы page (с 1, новые записи первыми) и число записей в периоде."""
+        lo, hi = self.range(user_id, start, end)
+        stop = max(lo, hi - (page - 1) * DKP_LOG_PAGE_SIZE)
+        return self.offsets.get(user_id, [])[max(lo, stop - DKP_LOG_PAGE_SIZE):stop], hi - lo
+
+    def between(self, user_id, start=None, end=None):
+        """Смещения всех строк пользователя за период."""
+        lo, hi = self.range(user_id, start, end)
+        return self.offsets.get(user_id, [])[lo:hi]
+
+def build_dkp_log_index():
+    """Один проход по dkp_log.jsonl: строит DkpLogIndex."""
+    index = DkpLogIndex()
+    try:
+        with open(DKP_EVENTS_FILE, "r+b") as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Запись оборвалась при падении - отрезаем хвост, чтобы следующая запись не склеилась с ним
+                    f.truncate(offset)
+                    break
+                try:
+                    index.add(json.loads(line), offset)
+                except (json.JSONDecodeError, KeyError, ValueError):
+                    print(f"[ERROR] Поврежденная запись в {DKP_EVENTS_FILE} (смещение {offset}), пропускаем")
+                offset += len(line)
+    except FileNotFoundError:
+        pass
+    return index
+
+def read_dkp_log_entries(offsets):
+    """Читает записи лога по смещениям из индекса, не трогая остальной файл."""
+    entries = []
+    with open(DKP_EVENTS_FILE, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            entries.append(json.loads(f.readline()))
+    return entries
+
+def iter_dkp_log_file():
+    """Все валидные записи dkp_log.jsonl по порядку."""
+    try:
+        with open(DKP_EVENTS_FILE, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        return
+
+def write_dkp_log_file(entries):
+    """Переписывает dkp_log.jsonl целиком через временный файл."""
+    write_file_atomic(DKP_EVENTS_FILE, "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+
+def convert_dkp_log_to_jsonl():
+    """Переводит старый dkp_log.json ({user_id: {display_name, logs}}) в dkp_log.jsonl."""
+    if not os.path.exists(DKP_LOG_FILE):
+        return 0
+    dkp_log = read_json_checked(DKP_LOG_FILE, {})
+
+    entries = [
+        {"user_id": user_id, "display_name": user_log.get("display_name"), **entry}
+        for user_id, user_log in dkp_log.items()
+        for entry in user_log.get("logs", [])
+    ]
+    # В старом формате записи сгруппированы по пользователям - восстанавливаем общий порядок по времени
+    for entry in entries:
+        entry["timestamp"] = to_epoch(entry["timestamp"])
+    entries.sort(key=lambda entry: entry["timestamp"])
+    write_dkp_log_file(entries)
+    print(f"[LOG] {DKP_LOG_FILE} переведен в {DKP_EVENTS_FILE}: {len(entries)} записей")
+    return len(entries)
+
+def migrate_dkp_log_timestamps():
+    """Переписывает dkp_log.jsonl с метками времени в epoch вместо строк."""
+    def convert(entry):
+        entry["timestamp"] = to_epoch(entry["timestamp"])
+        return entry
+
+    count = rewrite_dkp_log(convert)
+    print(f"[LOG] Метки времени в {DKP_EVENTS_FILE} переведены в epoch: {count} записей")
+    return count
+
+def append_dkp_wal(records):
+    """Дописывает транзакции в журнал одной записью и дожидается записи на диск."""
+    with open(DKP_WAL_FILE, "ab") as f:
+        f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+
+def recover_dkp_wal(data):
+    """Применяет к data транзакции из журнала и дописывает в лог недостающие записи.
+
+    Строка журнала - целая транзакция, поэтому оборванная при падении строка
+    отбрасывается целиком. Возвращает количество примененных транзакций."""
+    records = []
+    try:
+        with open(DKP_WAL_FILE, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    except FileNotFoundError:
+        return 0
+    if not records:
+        return 0
+
+    # Обрезаем оборванный хвост лога и считаем, сколько записей каждой транзакции уже в нем есть
+    build_dkp_log_index()
+    wal_txns = {record["txn"] for record in records}
+    logged_counts = {}
+    for entry in iter_dkp_log_file():
+        if entry.get("txn") in wal_txns:
+            logged_counts[entry["txn"]] = logged_counts.get(entry["txn"], 0) + 1
+
+    missing_entries = []
+    for record in records:
+        # В журнале лежат итоговые балансы, поэтому повторное применение безопасно
+        data.update(record["balances"])
+        missing_entries.extend(record["entries"][logged_counts.get(record["txn"], 0):])
+
+    if missing_entries:
+        with open(DKP_EVENTS_FILE, "ab") as f:
+            f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in missing_entries).encode("utf-8"))
+            # После восстановления журнал удаляется - записи должны быть на диске
+            f.flush()
+            os.fsync(f.fileno())
+    print(f"[DKP] Восстановлено транзакций из {DKP_WAL_FILE}: {len(records)}")
+    return len(records)
+
+def rewrite_dkp_log(transform):
+    """Переписывает dkp_log.jsonl: transform(entry) возвращает запись для нового файла или None
+    (строка выбрасывается). Смещения контрольных точек пересчитываются под новый файл."""
+    lines = []
+    moved = []  # [(смещение строки в старом файле, смещение в новом)]
+    new_offset = 0
+    try:
+        with open(DKP_EVENTS_FILE, "rb") as f:
+            old_offset = 0
+            for line in f:
+                line_offset, old_offset = old_offset, old_offset + len(line)
+                try:
+                    entry = transform(json.loads(line))
+                except (json.JSONDecodeError, KeyError, ValueError, TypeError):
+                    entry = None
+                if entry is None:
+                    continue
+                data = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+                moved.append((line_offset, new_offset))
+                lines.append(data)
+                new_offset += len(data)
+    except FileNotFoundError:
+        return 0
+    write_file_atomic(DKP_EVENTS_FILE, b"".join(lines))
+    remap_dkp_checkpoints(moved, new_offset)
+    return len(lines)
+
+def compact_dkp_log():
+    """Переписывает dkp_log.jsonl без поврежденных строк и пересобирает индекс."""
+    global dkp_log_index
+    count = rewrite_dkp_log(lambda entry: entry if isinstance(entry, dict) and "user_id" in entry and "amount" in entry else None)
+    dkp_log_index = build_dkp_log_index()
+    return count
+
+# SQLite-хранилище: балансы, лог DKP и лог аукционов в одной базе
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    user_id TEXT PRIMARY KEY,
+    display_name TEXT,
+    dkp INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    display_name TEXT,
+    timestamp INTEGER,
+    action TEXT,
+    amount INTEGER,
+    description TEXT,
+    balance INTEGER
+);
+CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id, id);
+CREATE INDEX IF NOT EXISTS ledger_user_time ON ledger (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS ledger_time ON ledger (timestamp);
+CREATE TABLE IF NOT EXISTS auctions (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    item TEXT,
+    description TEXT,
+    created_at INTEGER,
+    date_of_end INTEGER
+);
+CREATE INDEX IF NOT EXISTS auctions_created ON auctions (created_at);
+CREATE INDEX IF NOT EXISTS auctions_name ON auctions (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS auctions_item ON auctions (item COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp INTEGER NOT NULL,
+    ledger_id INTEGER NOT NULL,
+    balances TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS checkpoints_time ON checkpoints (timestamp);
+CREATE TABLE IF NOT EXISTS bids (
+    auction_id INTEGER NOT NULL,
+    place INTEGER NOT NULL,
+    user_id INTEGER,
+    amount INTEGER,
+    PRIMARY KEY (auction_id, place)
+);
+"""
+
+def connect_dkp_db(path=None):
+    conn = sqlite3.connect(path or DKP_DB_FILE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    migrate_db_timestamps(conn)
+    conn.executescript(DB_SCHEMA)
+    # Баланс после записи лога появился позже - старые базы получают пустую колонку
+    if "balance" not in {row[1] for row in conn.execute("PRAGMA table_info(ledger)")}:
+        conn.execute("ALTER TABLE ledger ADD COLUMN balance INTEGER")
+    return conn
+
+def migrate_db_timestamps(conn):
+    """Старые базы хранили метки времени строками (колонки TEXT) - пересоздаем ledger и auctions
+    с колонками INTEGER и переводим значения в epoch. Выполняется один раз."""
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(ledger)")}
+    if columns.get("timestamp", "INTEGER") == "INTEGER":
+        return
+    ledger_rows = conn.execute("SELECT id, user_id, display_name, timestamp, action, amount, description FROM ledger").fetchall()
+    auction_rows = conn.execute("SELECT id, name, item, description, created_at, date_of_end FROM auctions").fetchall()
+    conn.execute("BEGIN")
+    try:
+        # Таблицы создаст DB_SCHEMA уже с новыми типами колонок
+        conn.execute("DROP TABLE ledger")
+        conn.execute("DROP TABLE auctions")
+        for statement in DB_SCHEMA.split(";"):
+            if statement.strip():
+                conn.execute(statement)
+        conn.executemany(
+            "INSERT INTO ledger (id, user_id, display_name, timestamp, action, amount, description) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(row[0], row[1], row[2], to_epoch(row[3]), row[4], row[5], row[6]) for row in ledger_rows]
+        )
+        conn.executemany(
+            "INSERT INTO auctions (id, name, item, description, created_at, date_of_end) VALUES (?, ?, ?, ?, ?, ?)",
+            [(row[0], row[1], row[2], row[3], to_epoch(row[4]), to_epoch(row[5])) for row in auction_rows]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    print(f"[DB] Метки времени переведены в epoch: {len(ledger_rows)} записей лога, {len(auction_rows)} аукционов")
+
+def open_dkp_db():
+    global db_conn
+    if db_conn is None:
+        db_conn = connect_dkp_db()
+    return db_conn
+
+def read_dkp_db():
+    rows = db_conn.execute("SELECT user_id, display_name, dkp FROM members").fetchall()
+    return {row["user_id"]: {"display_name": row["display_name"], "dkp": row["dkp"]} for row in rows}
+
+def write_dkp_db(data):
+    with db_conn:
+        db_conn.execute("DELETE FROM members")
+        db_conn.executemany(
+            "INSERT INTO members (user_id, display_name, dkp) VALUES (?, ?, ?)",
+            [(user_id, user_data.get("display_name"), user_data["dkp"]) for user_id, user_data in data.items()]
+        )
+
+def migrate_json_to_sqlite(path=None):
+    """Переносит dkp_data.json, лог DKP и auc_log.json в SQLite (таблицы перезаписываются)."""
+    members = read_json_checked(DKP_FILE, {})
+    if os.path.exists(DKP_EVENTS_FILE):
+        log_entries = list(iter_dkp_log_file())
+    else:
+        log_entries = [
+            {"user_id": user_id, "display_name": user_log.get("display_name"), **entry}
+            for user_id, user_log in read_json_checked(DKP_LOG_FILE, {}).items()
+            for entry in user_log.get("logs", [])
+        ]
+    auction_log = read_json_checked(AUC_LOG_FILE, {})
+
+    conn = connect_dkp_db(path)
+    try:
+        with conn:
+            for table in ("members", "ledger", "auctions", "bids"):
+                conn.execute(f"DELETE FROM {table}")
+            conn.executemany(
+                "INSERT INTO members (user_id, display_name, dkp) VALUES (?, ?, ?)",
+                [(user_id, user_data.get("display_name"), user_data["dkp"]) for user_id, user_data in members.items()]
+            )
+            conn.executemany(
+                "INSERT INTO ledger (user_id, display_name, timestamp, action, amount, description) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (entry["user_id"], entry.get("display_name"), to_epoch(entry["timestamp"]), entry["action"], entry["amount"], entry.get("description", ""))
+                    for entry in log_entries
+                ]
+            )
+            auction_records = auction_log.get("auctions", {}).values()
+            conn.executemany(
+                "INSERT INTO auctions (id, name, item, description, created_at, date_of_end) VALUES (?, ?, ?, ?, ?, ?)",
+                [(auc["id"], auc["name"], auc["item"], auc["description"], to_epoch(auc["created_at"]), to_epoch(auc["date_of_end"])) for auc in auction_records]
+            )
+            conn.executemany(
+                "INSERT INTO bids (auction_id, place, user_id, amount) VALUES (?, ?, ?, ?)",
+                [
+                    (auc["id"], place, bid["user_id"], bid["amount"])
+                    for auc in auction_records
+                    for place, bid in enumerate(auc.get("top_3_bids", []), 1)
+                ]
+            )
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("members", "ledger", "auctions", "bids")}
+    finally:
+        conn.close()
+    return counts
+
+def db_apply_transaction(balances, entries):
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO members (user_id, display_name, dkp) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET dkp = excluded.dkp",
+            [(user_id, user_data.get("display_name"), user_data["dkp"]) for user_id, user_data in balances.items()]
+        )
+        db_conn.executemany(
+            "INSERT INTO ledger (user_id, display_name, timestamp, action, amount, description, balance) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(e["user_id"], e["display_name"], e["timestamp"], e["action"], e["amount"], e["description"], e.get("balance")) for e in entries]
+        )
+
+def db_user_logs(user_id, limit, offset=0, start=None, end=None):
+    """Записи пользователя (по порядку) и их общее число в диапазоне start..end; offset считается от новых."""
+    where = "user_id = ?"
+    params = [user_id]
+    if start:
+        where += " AND timestamp >= ?"
+        params.append(start)
+    if end:
+        where += " AND timestamp <= ?"
+        params.append(end)
+    total = db_conn.execute(f"SELECT COUNT(*) FROM ledger WHERE {where}", params).fetchone()[0]
+    rows = db_conn.execute(
+        f"SELECT timestamp, action, amount, description FROM ledger WHERE {where} ORDER BY id DESC LIMIT ? OFFSET ?",
+        params + [limit, offset]
+    ).fetchall()
+    return [dict(row) for row in reversed(rows)], total
+
+def db_user_totals(user_id, start=None, end=None):
+    """{action: сумма} по записям пользователя за период."""
+    rows = db_conn.execute(
+        "SELECT action, SUM(amount) FROM ledger WHERE user_id = ? AND timestamp BETWEEN ? AND ? GROUP BY action",
+        (user_id, start if start is not None else 0, end if end is not None else 2 ** 62)
+    ).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+def db_write_checkpoint(timestamp, balances):
+    with db_conn:
+        db_conn.execute(
+            "INSERT INTO checkpoints (timestamp, ledger_id, balances) SELECT ?, COALESCE(MAX(id), 0), ? FROM ledger",
+            (timestamp, json.dumps(balances))
+        )
+
+def db_last_checkpoint_time():
+    return db_conn.execute("SELECT COALESCE(MAX(timestamp), 0) FROM checkpoints").fetchone()[0]
+
+def db_balances_at(timestamp, user_id=None):
+    """Балансы на момент timestamp: ближайшая контрольная точка до него + записи лога после точки."""
+    row = db_conn.execute(
+        "SELECT ledger_id, balances FROM checkpoints WHERE timestamp <= ? ORDER BY timestamp DESC LIMIT 1", (timestamp,)
+    ).fetchone()
+    balances = json.loads(row["balances"]) if row else {}
+    where, params = "id > ? AND timestamp <= ?", [row["ledger_id"] if row else 0, timestamp]
+    if user_id is not None:
+        where += " AND user_id = ?"
+        params.append(user_id)
+        balances = {user_id: balances.get(user_id, 0)}
+    rows = db_conn.execute(f"SELECT user_id, action, amount, balance FROM ledger WHERE {where} ORDER BY id", params)
+    return replay_dkp_entries(balances, map(dict, rows))
+
+def db_auctions_between(start, end):
+    rows = db_conn.execute("SELECT id FROM auctions WHERE created_at BETWEEN ? AND ? ORDER BY created_at", (start, end)).fetchall()
+    return [db_auction_record(row[0]) for row in rows]
+
+def db_insert_auctions(records):
+    with db_conn:
+        db_conn.executemany(
+            "INSERT INTO auctions (id, name, item, description, created_at, date_of_end) VALUES (?, ?, ?, ?, ?, ?)",
+            [(record["id"], record["name"], record["item"], record["description"], record["created_at"], record["date_of_end"]) for record in records]
+        )
+
+def db_replace_bids(results):
+    """results: {auction_id: bids} - ставки нескольких аукционов в одной транзакции."""
+    with db_conn:
+        db_conn.executemany("DELETE FROM bids WHERE auction_id = ?", [(auction_id,) for auction_id in results])
+        db_conn.executemany(
+            "INSERT INTO bids (auction_id, place, user_id, amount) VALUES (?, ?, ?, ?)",
+            [(auction_id, place, bid["user_id"], bid["amount"]) for auction_id, bids in results.items() for place, bid in enumerate(bids, 1)]
+        )
+
+def db_last_auction_id():
+    return db_conn.execute("SELECT COALESCE(MAX(id), 0) FROM auctions").fetchone()[0]
+
+def db_find_auctions(name):
+    """ID аукционов, где босс или предмет совпадает с name (без учета регистра)."""
+    rows = db_conn.execute(
+        "SELECT id FROM auctions WHERE name = ? COLLATE NOCASE UNION SELECT id FROM auctions WHERE item = ? COLLATE NOCASE ORDER BY id",
+        (name, name)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+def db_auction_record(auction_id):
+    """Возвращает запись аукциона из SQLite в том же виде, что и в auc_log.json."""
+    row = db_conn.execute("SELECT * FROM auctions WHERE id = ?", (auction_id,)).fetchone()
+    if row is None:
+        return None
+    bids = db_conn.execute(
+        "SELECT user_id, amount FROM bids WHERE auction_id = ? ORDER BY place", (auction_id,)
+    ).fetchall()
+    record = dict(row)
+    record["top_3_bids"] = [{"user_id": bid["user_id"], "amount": bid["amount"]} for bid in bids]
+    return record
+
+class BidBook:
+    """Ставки одного аукциона: поиск по пользователю за O(1) и список по убыванию суммы.
+
+    При равных суммах выше стоит более ранняя ставка. Перебор дает словари
+    {"user": user_id, "amount": amount}, как в старом списке bids."""
+
+    def __init__(self, bids=()):
+        self.by_user = {}  # {user_id: (-amount, seq)}
+        self.ordered = []  # [(-amount, seq, user_id)], отсортирован
+        self.seq = 0
+        for b in bids:
+            self.place(b["user"], b["amount"])
+
+    def place(self, user_id, amount):
+        self.remove(user_id)
+        self.seq += 1
+        key = (-amount, self.seq)
+        self.by_user[user_id] = key
+        bisect.insort(self.ordered, (*key, user_id))
+
+    def remove(self, user_id):
+        """Удаляет ставку пользователя и возвращает ее сумму (None, если ставки не было)."""
+        key = self.by_user.pop(user_id, None)
+        if key is None:
+            return None
+        del self.ordered[bisect.bisect_left(self.ordered, (*key, user_id))]
+        return -key[0]
+
+    def get(self, user_id):
+        key = self.by_user.get(user_id)
+        return -key[0] if key else None
+
+    def highest(self):
+        return self.top(1)[0] if self.ordered else None
+
+    def top(self, n):
+        return [{"user": user_id, "amount": -neg_amount} for neg_amount, _, user_id in self.ordered[:n]]
+
+    def __iter__(self):
+        return iter(self.top(len(self.ordered)))
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def to_list(self):
+        return list(self)
+
+def hold_bid(user_id, auction_id, amount):
+    """Блокирует DKP пользователя под ставку на аукцион."""
+    release_bid(user_id, auction_id)
+    bid_holds.setdefault(user_id, {})[auction_id] = amount
+    locked_dkp_totals[user_id] = locked_dkp_totals.get(user_id, 0) + amount
+
+def release_bid(user_id, auction_id):
+    """Снимает блокировку ставки (перебита, удалена или аукцион завершен)."""
+    user_holds = bid_holds.get(user_id)
+    if not user_holds or auction_id not in user_holds:
+        return
+    locked_dkp_totals[user_id] -= user_holds.pop(auction_id)
+    if not user_holds:
+        del bid_holds[user_id]
+        del locked_dkp_totals[user_id]
+
+def free_dkp(user_id):
+    """Свободные DKP: баланс минус заблокированные под ставки. Проверку и последующее
+    изменение делайте под lock_members этого пользователя."""
+    return dkp_data.get(str(user_id), {"dkp": 0})["dkp"] - locked_dkp_totals.get(int(user_id), 0)
+
+class MemberLocks:
+    """Блокировки нескольких участников сразу.
+
+    Полосы берутся по возрастанию номера, поэтому две транзакции с общими участниками
+    не могут заблокировать друг друга. Не реентерабельно: внутри блока не вызывайте
+    функции, которые сами берут блокировки тех же участников."""
+
+    def __init__(self, user_ids):
+        stripes = sorted({int(user_id) % DKP_LOCK_STRIPES for user_id in user_ids})
+        self.locks = [member_locks[stripe] for stripe in stripes]
+
+    async def __aenter__(self):
+        acquired = []
+        try:
+            for lock in self.locks:
+                await lock.acquire()
+                acquired.append(lock)
+        except BaseException:
+            for lock in reversed(acquired):
+                lock.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        for lock in reversed(self.locks):
+            lock.release()
+
+def lock_members(user_ids):
+    return MemberLocks(user_ids)
+
+class Leaderboard:
+    """Участники по убыванию DKP (при равных - по ID), обновляется при каждом изменении баланса.
+
+    keys - отсортированный список (-dkp, user_id), поэтому место участника ищется
+    бинарным поиском, а топ и страницы - срезом. version растет при каждом изменении:
+    по нему сбрасываются закэшированные страницы /alldkp."""
+
+    def __init__(self):
+        self.keys = []
+        self.by_user = {}  # {user_id (str): (-dkp, int user_id)}
+        self.version = 0
+
+    def rebuild(self, data):
+        self.by_user = {user_id: (-user_data["dkp"], int(user_id)) for user_id, user_data in data.items()}
+        self.keys = sorted(self.by_user.values())
+        self.version += 1
+
+    def update(self, user_id, dkp):
+        key = (-dkp, int(user_id))
+        old_key = self.by_user.get(user_id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            del self.keys[bisect.bisect_left(self.keys, old_key)]
+        bisect.insort(self.keys, key)
+        self.by_user[user_id] = key
+        self.version += 1
+
+    def remove(self, user_id):
+        old_key = self.by_user.pop(user_id, None)
+        if old_key is not None:
+            del self.keys[bisect.bisect_left(self.keys, old_key)]
+            self.version += 1
+
+    def rank(self, user_id):
+        """Место участника (с 1) или None, если его нет в базе."""
+        key = self.by_user.get(user_id)
+        return bisect.bisect_left(self.keys, key) + 1 if key is not None else None
+
+    def slice(self, start, stop):
+        """[(user_id, dkp)] для мест start..stop-1 (с 0)."""
+        return [(str(user_id), -neg_dkp) for neg_dkp, user_id in self.keys[start:stop]]
+
+    def top(self, count):
+        return self.slice(0, count)
+
+    def __iter__(self):
+        return iter(self.slice(0, len(self.keys)))
+
+    def __len__(self):
+        return len(self.keys)
+
+leaderboard = Leaderboard()
+
+# Страницы /alldkp: по LEADERBOARD_PAGE_SIZE строк, рисуются по запросу и кэшируются до изменения балансов
+LEADERBOARD_PAGE_SIZE = 25
+leaderboard_pages = {"version": None, "pages": {}}
+
+async def render_leaderboard_page(guild, page):
+    """Текст страницы page (с 0) таблицы DKP; имена запрашиваются только для этой страницы."""
+    if leaderboard_pages["version"] != leaderboard.version:
+        leaderboard_pages["version"] = leaderboard.version
+        leaderboard_pages["pages"] = {}
+    cached = leaderboard_pages["pages"].get(page)
+    if cached is not None:
+        return cached
+
+    version = leaderboard.version
+    start = page * LEADERBOARD_PAGE_SIZE
+    rows = leaderboard.slice(start, start + LEADERBOARD_PAGE_SIZE)
+    users = await resolve_users(guild, [user_id for user_id, _ in rows])
+    lines = []
+    for place, (user_id, dkp) in enumerate(rows, start + 1):
+        user = users[int(user_id)]
+        name = member_name(user) if user else f"Unknown user (ID {user_id})"
+        lines.append(f"{place}. {name}: {dkp} DKP")
+    text = "\n".join(lines)
+    # Пока запрашивали имена, балансы могли измениться - такую страницу не кэшируем
+    if version == leaderboard.version:
+        leaderboard_pages["pages"][page] = text
+    return text
+
+def chunk_lines(lines, limit=2000, max_lines=50):
+    """Делит строки на страницы не длиннее limit символов и не больше max_lines строк."""
+    pages, current, size = [], [], 0
+    for line in lines:
+        if current and (size + len(line) + 1 > limit or len(current) >= max_lines):
+            pages.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        pages.append("\n".join(current))
+    return pages
+
+# Страницы /listrole: {role_id: [текст страницы]}, сбрасываются при изменении ролей участников
+role_pages = {}
+
+def get_role_pages(role):
+    pages = role_pages.get(role.id)
+    if pages is None:
+        pages = role_pages[role.id] = chunk_lines([member.mention for member in role.members])
+    return pages
+
+async def dkp_page(guild, arg, page):
+    page_count = max(1, (len(leaderboard) + LEADERBOARD_PAGE_SIZE - 1) // LEADERBOARD_PAGE_SIZE)
+    page = min(page, page_count - 1)
+    text = await render_leaderboard_page(guild, page)
+    embed = discord.Embed(title="📜 All Players and Their DKP", description=text or "No users with DKP found.", color=discord.Color.blue())
+    return embed, page, page_count
+
+async def role_page(guild, role_id, page):
+    role = guild.get_role(role_id)
+    if role is None:
+        return discord.Embed(description="❌ This role no longer exists.", color=discord.Color.red()), 0, 1
+    pages = get_role_pages(role)
+    page = min(page, max(len(pages), 1) - 1)
+    embed = discord.Embed(
+        title=f"Members with role: {role.name}",
+        description=pages[page] if pages else f"❌ No members have the role **{role.name}**.",
+        color=role.color
+    )
+    return embed, page, max(len(pages), 1)
+
+# Источники страниц по имени из custom_id кнопки: page_sources[source](guild, arg, page) -> (embed, page, page_count)
+page_sources = {"dkp": dkp_page, "role": role_page}
+
+class PageButton(ui.DynamicItem[ui.Button], template=r"page:(?P<source>[a-z]+):(?P<arg>\d+):(?P<page>\d+)"):
+    """Кнопка листания: источник, его аргумент и номер страницы хранятся в custom_id,
+    поэтому кнопки работают и на старых сообщениях после рестарта бота."""
+
+    def __init__(self, source, arg, page, label, disabled=False):
+        super().__init__(ui.Button(
+            label=label,
+            style=discord.ButtonStyle.secondary,
+            disabled=disabled,
+            custom_id=f"page:{source}:{arg}:{page}"
+        ))
+        self.source = source
+        self.arg = arg
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["source"], int(match["arg"]), int(match["page"]), item.label)
+
+    async def callback(self, interaction):
+        render = page_sources.get(self.source)
+        if render is None:
+            await interaction.response.send_message("❌ This list is no longer available.", ephemeral=True)
+            return
+        await interaction.response.defer()
+        # Рисуем только запрошенную страницу
+        embed, page, page_count = await render(interaction.guild, self.arg, self.page)
+        await interaction.edit_original_response(embed=embed, view=pager_view(self.source, self.arg, page, page_count))
+
+def pager_view(source, arg, page, page_count):
+    """Кнопки ◀ / номер страницы / ▶; для одной страницы кнопки не нужны."""
+    if page_count <= 1:
+        return None
+    view = ui.View(timeout=None)
+    view.add_item(PageButton(source, arg, max(page - 1, 0), "◀", disabled=page == 0))
+    view.add_item(ui.Button(label=f"{page + 1}/{page_count}", disabled=True))
+    view.add_item(PageButton(source, arg, min(page + 1, page_count - 1), "▶", disabled=page == page_count - 1))
+    return view
+
+def release_auction_holds(auction):
+    for b in auction["bids"]:
+        release_bid(b["user"], auction["id"])
 
 # Функция для автодополнения списка активных аукционов (добавляем описание)
 async def auction_autocomplete(interaction: discord.Interaction, current: str):
@@ -79,6 +1084,265 @@ async def role_autocomplete(interaction: discord.Interaction, current: str):
         if current.lower() in role.lower()
     ]
 
+def cache_user(user):
+    user_cache[user.id] = (time.monotonic() + USER_CACHE_TTL, user)
+    user_cache.move_to_end(user.id)
+    while len(user_cache) > USER_CACHE_SIZE:
+        user_cache.popitem(last=False)
+
+def cached_user(user_id):
+    cached = user_cache.get(user_id)
+    if cached is None:
+        return None
+    expires_at, user = cached
+    if expires_at < time.monotonic():
+        del user_cache[user_id]
+        return None
+    user_cache.move_to_end(user_id)
+    return user
+
+async def resolve_users(guild, user_ids):
+    """Находит пользователей по ID: участник сервера из кэша гильдии -> LRU-кэш -> один пакетный запрос.
+
+    Возвращает {user_id: Member | User | None}, None - пользователь не найден."""
+    resolved = {}
+    missing = []
+    for user_id in dict.fromkeys(int(user_id) for user_id in user_ids):
+        user = (guild.get_member(user_id) if guild else None) or cached_user(user_id) or bot.get_user(user_id)
+        resolved[user_id] = user
+        if user is None:
+            missing.append(user_id)
+
+    if missing:
+        # Запрашиваем всех недостающих одновременно, а не по одному
+        results = await asyncio.gather(*(bot.fetch_user(user_id) for user_id in missing), return_exceptions=True)
+        for user_id, user in zip(missing, results):
+            if isinstance(user, discord.User):
+                cache_user(user)
+                resolved[user_id] = user
+    return resolved
+
+def member_name(user, fallback="Unknown"):
+    """Ник на сервере для участника, имя аккаунта для остальных."""
+    if user is None:
+        return fallback
+    return user.display_name if isinstance(user, discord.Member) else user.name
+
+@bot.event
+async def on_member_update(before, after):
+    user_cache.pop(after.id, None)
+    # Страницы /listrole устарели только для ролей, которые изменились
+    for role in set(before.roles) ^ set(after.roles):
+        role_pages.pop(role.id, None)
+
+@bot.event
+async def on_member_join(member):
+    for role in member.roles:
+        role_pages.pop(role.id, None)
+
+@bot.event
+async def on_member_remove(member):
+    for role in member.roles:
+        role_pages.pop(role.id, None)
+
+@bot.event
+async def on_user_update(before, after):
+    user_cache.pop(after.id, None)
+
+def index_guild_channels(guild):
+    names = {BIDS_CHANNEL, LIVE_AUCTIONS_CHANNEL, RESULTS_CHANNEL}
+    channel_registry[guild.id] = {channel.name: channel.id for channel in guild.text_channels if channel.name in names}
+
+def index_guild_roles(guild):
+    role_registry[guild.id] = {role.name: role.id for role in guild.roles if role.name in AVAILABLE_ROLES}
+
+def get_channel(guild, name):
+    """Канал бота по имени через реестр ID, без перебора guild.text_channels."""
+    if guild.id not in channel_registry:
+        index_guild_channels(guild)
+    channel_id = channel_registry[guild.id].get(name)
+    return guild.get_channel(channel_id) if channel_id else None
+
+def get_role(guild, name):
+    """Роль из AVAILABLE_ROLES по имени через реестр ID, без перебора guild.roles."""
+    if guild.id not in role_registry:
+        index_guild_roles(guild)
+    role_id = role_registry[guild.id].get(name)
+    return guild.get_role(role_id) if role_id else None
+
+# Исходящие запросы к Discord (отправка, правка, удаление сообщений) идут через очередь:
+# обработчик ставит запрос и сразу возвращается, медленный или ограниченный канал его не держит
+OUTBOX_HIGH, OUTBOX_NORMAL, OUTBOX_LOW = 0, 1, 2
+OUTBOX_MAX_RETRIES = int(os.environ.get('OUTBOX_MAX_RETRIES', 5))
+# При такой глубине очереди канала косметические правки (droppable) отбрасываются
+OUTBOX_PRESSURE = int(os.environ.get('OUTBOX_PRESSURE', 20))
+# Результат отброшенного запроса - вызывающий сам решает, повторить ли его позже
+OUTBOX_DROPPED = object()
+
+class Outbox:
+    """Своя очередь на каждый канал, внутри - по приоритету, при равном - по порядку.
+
+    OUTBOX_HIGH - ответы пользователю и итоги аукционов, OUTBOX_NORMAL - объявления,
+    OUTBOX_LOW - правки и удаления. Запрос с key заменяет ждущий запрос с тем же key,
+    уведомления (notice) сливаются в одно сообщение. Временные ошибки (429, 5xx)
+    повторяются с растущей паузой. submit возвращает future с результатом запроса."""
+
+    def __init__(self):
+        self.queues = {}  # {channel_key: [(priority, seq, job)]}
+        self.pending = {}  # {(channel_key, key): job}
+        self.workers = {}  # {channel_key: task}
+        self.seq = itertools.count()
+        self.stats = {"sent": 0, "retries": 0, "failed": 0, "dropped": 0, "coalesced": 0}
+
+    @staticmethod
+    def channel_key(target):
+        # Ответы на interaction идут через webhook со своим лимитом; interaction.followup
+        # каждый раз новый объект, поэтому очередь определяем по токену interaction
+        if isinstance(target, discord.Webhook):
+            return target.token
+        channel = getattr(target, "channel", target)  # Context -> канал
+        return getattr(channel, "id", None) or id(channel)
+
+    def submit(self, target, action, priority=OUTBOX_NORMAL, key=None, droppable=False):
+        channel_key = self.channel_key(target)
+        queue = self.queues.setdefault(channel_key, [])
+        job = self.pending.get((channel_key, key)) if key is not None else None
+        if job is not None:
+            job["action"] = action
+            self.stats["coalesced"] += 1
+            return job["future"]
+
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку уже напечатали в fail - не даем asyncio ругаться на непрочитанное исключение
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if droppable and len(queue) >= OUTBOX_PRESSURE:
+            self.stats["dropped"] += 1
+            future.set_result(OUTBOX_DROPPED)
+            return future
+
+        job = {"action": action, "future": future, "key": key}
+        heapq.heappush(queue, (priority, next(self.seq), job))
+        if key is not None:
+            self.pending[(channel_key, key)] = job
+        if channel_key not in self.workers:
+            self.workers[channel_key] = asyncio.create_task(self.run(channel_key))
+        return future
+
+    def notice(self, channel, line, priority=OUTBOX_NORMAL):
+        """Короткое уведомление; ждущие в очереди уведомления канала уходят одним сообщением."""
+        pending_key = (self.channel_key(channel), "notice")
+        job = self.pending.get(pending_key)
+        if job is not None:
+            if len(job["lines"]) < 20:  # 20 строк укладываются в лимит 2000 символов
+                job["lines"].append(line)
+                self.stats["coalesced"] += 1
+                return job["future"]
+            # Пачка заполнена - она остается в очереди как есть, новые строки копятся в следующей
+            del self.pending[pending_key]
+        lines = [line]
+        future = self.submit(channel, lambda: channel.send("\n".join(lines)), priority, key="notice")
+        self.pending[pending_key]["lines"] = lines
+        return future
+
+    async def run(self, channel_key):
+        queue = self.queues[channel_key]
+        try:
+            while queue:
+                _, _, job = heapq.heappop(queue)
+                # Ключ мог уже перейти к более новой задаче (заполненная пачка уведомлений)
+                if job["key"] is not None and self.pending.get((channel_key, job["key"])) is job:
+                    del self.pending[(channel_key, job["key"])]
+                await self.execute(job)
+        finally:
+            del self.workers[channel_key]
+            if not queue:
+                del self.queues[channel_key]
+
+    async def execute(self, job):
+        for attempt in range(OUTBOX_MAX_RETRIES + 1):
+            try:
+                result = await job["action"]()
+            except discord.HTTPException as e:
+                # 429 и 5xx - временные ошибки; нет прав или сообщение удалено - повторять бессмысленно
+                if (e.status == 429 or e.status >= 500) and attempt < OUTBOX_MAX_RETRIES:
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(min(2 ** attempt, 60))
+                    continue
+                self.fail(job, e)
+                return
+            except Exception as e:
+                self.fail(job, e)
+                return
+            self.stats["sent"] += 1
+            if not job["future"].done():
+                job["future"].set_result(result)
+            return
+
+    def fail(self, job, error):
+        self.stats["failed"] += 1
+        print(f"[ERROR] Не удалось отправить запрос в Discord: {error}")
+        if not job["future"].done():
+            job["future"].set_exception(error)
+
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def drain(self, timeout=None):
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()), timeout=timeout)
+
+outbox = Outbox()
+
+def send_message(target, content=None, priority=OUTBOX_NORMAL, **kwargs):
+    """Ставит target.send(...) в очередь. Ждать результат (await) нужно, только если нужен сам Message."""
+    return outbox.submit(target, lambda: target.send(content, **kwargs), priority)
+
+def send_notice(channel, line):
+    return outbox.notice(channel, line)
+
+def edit_message(channel, message_id, priority=OUTBOX_LOW, key=None, droppable=False, **kwargs):
+    return outbox.submit(channel, lambda: channel.get_partial_message(message_id).edit(**kwargs), priority, key, droppable)
+
+def delete_message(channel, message_id, priority=OUTBOX_LOW):
+    async def delete():
+        try:
+            await channel.get_partial_message(message_id).delete()
+        except discord.NotFound:
+            pass  # Уже удалено
+    return outbox.submit(channel, delete, priority)
+
+# Реестр пересобирается только при изменении каналов и ролей
+@bot.event
+async def on_guild_channel_create(channel):
+    index_guild_channels(channel.guild)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    index_guild_channels(channel.guild)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name:
+        index_guild_channels(after.guild)
+
+@bot.event
+async def on_guild_role_create(role):
+    index_guild_roles(role.guild)
+
+@bot.event
+async def on_guild_role_delete(role):
+    index_guild_roles(role.guild)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    if before.name != after.name:
+        index_guild_roles(after.guild)
+
+@bot.event
+async def on_guild_available(guild):
+    index_guild_channels(guild)
+    index_guild_roles(guild)
+
 # Функция для добавления ролей
 @bot.tree.command(name="addroles", description="Add yourself one or multiple roles: Tank, DD, Healer.")
 @app_commands.autocomplete(roles=role_autocomplete)
@@ -96,7 +1360,7 @@ async def add_roles(interaction: discord.Interaction, roles: str):
 
     added_roles = []
     for role_name in selected_roles:
-        role_obj = discord.utils.get(guild.roles, name=role_name)
+        role_obj = get_role(guild, role_name)
         if role_obj and role_obj not in member.roles:
             await member.add_roles(role_obj)
             added_roles.append(role_name)
@@ -109,21 +1373,14 @@ async def add_roles(interaction: discord.Interaction, roles: str):
 # Функция для показа людей из списка ролей
 @bot.tree.command(name="listrole", description="Shows all members with the specified role.")
 async def list_role(interaction: discord.Interaction, role: discord.Role):
-    """Показывает всех пользователей с данной ролью."""
-    members_with_role = [member.mention for member in role.members]
-
-    if not members_with_role:
+    """Показывает всех пользователей с данной ролью (по страницам)."""
+    if not get_role_pages(role):
         await interaction.response.send_message(f"❌ No members have the role **{role.name}**.", ephemeral=True)
         return
 
-    members_list = "\n".join(members_with_role)
-    embed = discord.Embed(
-        title=f"Members with role: {role.name}",
-        description=members_list,
-        color=role.color
-    )
-
-    await interaction.response.send_message(embed=embed)
+    embed, page, page_count = await role_page(interaction.guild, role.id, 0)
+    view = pager_view("role", role.id, page, page_count)
+    await interaction.response.send_message(embed=embed, view=view or discord.utils.MISSING)
             
 @bot.command()
 @commands.has_any_role('Leader')
@@ -134,17 +1391,19 @@ async def add_members(ctx):
 
     added_members = 0
 
-    for member in guild.members:
-        if not member.bot:  # Игнорируем ботов
-            user_id = str(member.id)
-            if user_id not in dkp_data:
-                dkp_data[user_id] = {
-                    "display_name": member.display_name,
-                    "dkp": 0  # Начальное значение DKP можно изменить
-                }
-                added_members += 1
+    async with lock_members(member.id for member in guild.members):
+        for member in guild.members:
+            if not member.bot:  # Игнорируем ботов
+                user_id = str(member.id)
+                if user_id not in dkp_data:
+                    dkp_data[user_id] = {
+                        "display_name": member.display_name,
+                        "dkp": 0  # Начальное значение DKP можно изменить
+                    }
+                    leaderboard.update(user_id, 0)
+                    added_members += 1
 
-    await save_dkp_data(dkp_data)  # Сохраняем обновленные данные
+        await save_dkp_data(dkp_data)  # Сохраняем обновленные данные
 
     await ctx.send(f"✅ Added {added_members} new members to the DKP database.")
 
@@ -158,12 +1417,14 @@ async def updm_names(ctx):
         await ctx.send("This command must be used in a server.")
         return
 
-    for member in ctx.guild.members:
-        user_id = str(member.id)
-        if user_id in dkp_data:
-            dkp_data[user_id]["display_name"] = member.display_name
+    async with lock_members(member.id for member in ctx.guild.members):
+        for member in ctx.guild.members:
+            user_id = str(member.id)
+            if user_id in dkp_data:
+                dkp_data[user_id]["display_name"] = member.display_name
+        leaderboard.version += 1  # Имена на закэшированных страницах устарели
 
-    await save_dkp_data(dkp_data)
+        await save_dkp_data(dkp_data)
     await ctx.send("Display names updated successfully.")
 
 def format_seconds(seconds):
@@ -180,10 +1441,10 @@ async def mybids(interaction: discord.Interaction):
     global auctions
     user = interaction.user
     user_bids = [
-        f"**{name}** - {auction['item']}: **{bid['amount']} DKP**"
-        for name, auction in auctions.items()
-        for bid in auction["bids"]
-        if bid["user"] == user.id
+        f"**{auction_id}** - {auctions[auction_id]['item']}: **{amount} DKP**"
+        for auction_id, amount in bid_holds.get(user.id, {}).items()
+        # Завершенный аукцион держит ставку, пока идет расчет, но в auctions его уже нет
+        if auction_id in auctions
     ]
 
     if user_bids:
@@ -228,23 +1489,20 @@ async def bid(interaction: discord.Interaction, auction_id: str, amount: int):
     auction_id = int(auction_id)
     current_time = time.time()
 
-    channel = discord.utils.get(interaction.guild.text_channels, name="💰bidschannel💰")
+    channel = get_channel(interaction.guild, BIDS_CHANNEL)
     if not channel:
-        await interaction.followup.send("Error: Channel '💰bidschannel💰' not found.", ephemeral=True)
+        send_message(interaction.followup, f"Error: Channel '{BIDS_CHANNEL}' not found.", ephemeral=True, priority=OUTBOX_HIGH)
         return
 
     auction = auctions.get(auction_id)
     if not auction:
-        await interaction.followup.send(f"Auction with ID '{auction_id}' does not exist.", ephemeral=True)
+        send_message(interaction.followup, f"Auction with ID '{auction_id}' does not exist.", ephemeral=True, priority=OUTBOX_HIGH)
         return
 
     if current_time > auction["end_time"]:
-        await interaction.followup.send(f"The auction for **{auction['item']}** has ended!", ephemeral=True)
+        send_message(interaction.followup, f"The auction for **{auction['item']}** has ended!", ephemeral=True, priority=OUTBOX_HIGH)
         return
 
-    highest_bid = auction.get("highest_bid", 0)
-    highest_bidder = auction.get("highest_bidder", None)  # ID текущего лидера
-
     # **Проверяем таймер (30 минут между ставками на один аукцион)**
     if auction_id in last_bid_times and user.id in last_bid_times[auction_id]:
         last_bid_time = last_bid_times[auction_id][user.id]
@@ -254,70 +1512,71 @@ async def bid(interaction: discord.Interaction, auction_id: str, amount: int):
             remaining_time = 30 - time_since_last_bid
             minutes = int(remaining_time // 60)
             seconds = int(remaining_time % 60)
-            await interaction.followup.send(
+            send_message(
+                interaction.followup,
                 f"⏳ {user.mention}, you can bid again in {minutes}m {seconds}s.",
-                ephemeral=True
+                ephemeral=True, priority=OUTBOX_HIGH
             )
             return
-            
-    if amount <= highest_bid + 99:
-        await interaction.followup.send(
-            f"❌ Your bid must be **higher on 100** than the current highest bid (**{highest_bid} DKP**).",
-            ephemeral=True
-        )
-        return
 
-    # Загружаем данные DKP
-    dkp_data = await load_dkp_data()
-    user_dkp = dkp_data.get(str(user.id), {"dkp": 0})["dkp"]
+    # Проверка баланса и блокировка ставки идут под блокировкой участника, чтобы параллельные
+    # ставки и списания не потратили одни и те же DKP дважды
+    async with lock_members([user.id]):
+        if auctions.get(auction_id) is not auction:
+            send_message(interaction.followup, f"The auction for **{auction['item']}** has ended!", ephemeral=True, priority=OUTBOX_HIGH)
+            return
 
-    # Подсчет уже заблокированных (использованных) DKP
-    locked_dkp = sum(
-        bid["amount"] for auc in auctions.values() for bid in auc["bids"] if bid["user"] == user.id
-    )
+        highest_bid = auction.get("highest_bid", 0)
+        highest_bidder = auction.get("highest_bidder", None)  # ID текущего лидера
 
-    # Проверяем, может ли пользователь сделать ставку
-    available_dkp = user_dkp - locked_dkp  # Свободные DKP
-    if amount > available_dkp:
-        await interaction.followup.send(
-            f"❌ You only have **{available_dkp} DKP** available to bid. You cannot place this bid.",
-            ephemeral=True
-        )
-        return
+        if amount <= highest_bid + 99:
+            send_message(
+                interaction.followup,
+                f"❌ Your bid must be **higher on 100** than the current highest bid (**{highest_bid} DKP**).",
+                ephemeral=True, priority=OUTBOX_HIGH
+            )
+            return
 
-    # **Возвращаем DKP предыдущему лидеру (разблокируем, но не увеличиваем баланс)**
-    if highest_bidder:
-        prev_bid = next((b for b in auction["bids"] if b["user"] == highest_bidder), None)
-        if prev_bid:
-            auction["bids"].remove(prev_bid)  # Удаляем ставку из списка
+        # Проверяем, может ли пользователь сделать ставку
+        available_dkp = free_dkp(user.id)  # Баланс минус уже заблокированные под ставки DKP
+        if amount > available_dkp:
+            send_message(
+                interaction.followup,
+                f"❌ You only have **{available_dkp} DKP** available to bid. You cannot place this bid.",
+                ephemeral=True, priority=OUTBOX_HIGH
+            )
+            return
+
+        # **Возвращаем DKP предыдущему лидеру (разблокируем, но не увеличиваем баланс)**
+        if highest_bidder:
+            if auction["bids"].remove(highest_bidder) is not None:  # Удаляем ставку из книги ставок
+                release_bid(highest_bidder, auction_id)
 
-        prev_leader = await bot.fetch_user(highest_bidder)
-        await channel.send(f"🔄 {prev_leader.mention}, your **{highest_bid} DKP** have been unlocked.")
+        # **Обновляем аукцион с новой ставкой**
+        auction["highest_bid"] = amount
+        auction["highest_bidder"] = user.id
+        auction["bids"].place(user.id, amount)
+        hold_bid(user.id, auction_id, amount)
 
-    # **Обновляем аукцион с новой ставкой**
-    auction["highest_bid"] = amount
-    auction["highest_bidder"] = user.id
-    auction["bids"].append({"user": user.id, "amount": amount})
+    if highest_bidder:
+        # Для упоминания достаточно ID; уведомления, ждущие отправки, сливаются в одно сообщение
+        send_notice(channel, f"🔄 <@{highest_bidder}>, your **{highest_bid} DKP** have been unlocked.")
     
+    # Продление видно на доске аукционов (новый обратный отсчет)
     time_left = auction["end_time"] - current_time
     if time_left < 300:  # 300 секунд = 5 минут
       auction["end_time"] = current_time + 300
-      await channel.send(f"⏱️ Time extended! New end time for auction {auction_id} is in 5 minutes due to recent bid.")
+      schedule_auction(auction_id, auction["end_time"])  # Переносим таймер завершения
 
     # **Обновляем таймер для пользователя**
     if auction_id not in last_bid_times:
         last_bid_times[auction_id] = {}
     last_bid_times[auction_id][user.id] = current_time
+    mark_auctions_dirty()
 
-    embed = discord.Embed(
-        description=f"## {user.display_name} placed a bid of **{amount} DKP**.\n"
-                    f"## Auction ID: **{auction_id}**\n"
-                    f"## Item: **{auction['item']}**.",
-        color=discord.Color.green()
-    )
-
-    await channel.send(embed=embed)
-    await interaction.followup.send(f"✅ Your bid of {amount} DKP for **{auction['item']}** has been placed.", ephemeral=True)
+    # Вместо отдельного сообщения на каждую ставку обновляем доску аукционов
+    request_board_update(auction["guild_id"])
+    send_message(interaction.followup, f"✅ Your bid of {amount} DKP for **{auction['item']}** has been placed.", ephemeral=True, priority=OUTBOX_HIGH)
 
 # Функция для удаления ставки на конкретный аукцион
 @bot.tree.command(name="dbid", description="Admin removes a specific user's bid from an auction.")
@@ -341,100 +1600,390 @@ async def dbid(interaction: discord.Interaction, auction_id: str, member: discor
     auction = auctions[auction_id]
 
     # Проверяем, есть ли ставка от выбранного пользователя
-    existing_bid = next((b for b in auction["bids"] if b["user"] == member.id), None)
-    if not existing_bid:
+    existing_amount = auction["bids"].get(member.id)
+    if existing_amount is None:
         await interaction.response.send_message(f"❌ {member.display_name} has no bid in auction ID '{auction_id}'.", ephemeral=True)
         return
 
-    # Удаляем ставку пользователя
-    auction["bids"].remove(existing_bid)
-
-    # Возвращаем баланс DKP пользователю
-    dkp_data = await load_dkp_data()
-    user_dkp = dkp_data.get(str(member.id), {"dkp": 0})["dkp"]
-    dkp_data[str(member.id)]["dkp"] = user_dkp + existing_bid["amount"]
-    await save_dkp_data(dkp_data)
+    # Удаляем ставку пользователя и возвращаем ему DKP
+    async with lock_members([member.id]):
+        # Пока ждали блокировку, аукцион мог завершиться, а ставка - измениться: проверяем заново
+        if auctions.get(auction_id) is not auction:
+            await interaction.response.send_message(f"Auction with ID '{auction_id}' has already ended.", ephemeral=True)
+            return
+        existing_amount = auction["bids"].get(member.id)
+        if existing_amount is None:
+            await interaction.response.send_message(f"❌ {member.display_name} has no bid in auction ID '{auction_id}'.", ephemeral=True)
+            return
+        auction["bids"].remove(member.id)
+        release_bid(member.id, auction_id)
+        await submit_ledger_mutation(dkp_mutation([(member, existing_amount, "added", "")], log=False))
 
     # Обновляем максимальную ставку
     if auction["bids"]:
-        highest_bid = max(auction["bids"], key=lambda b: b["amount"])
+        highest_bid = auction["bids"].highest()
         auction["highest_bid"] = highest_bid["amount"]
         auction["highest_bidder"] = highest_bid["user"]
     else:
         auction["highest_bid"] = 0
         auction["highest_bidder"] = None
+    mark_auctions_dirty()
+    request_board_update(auction["guild_id"])
 
     # Ищем канал для уведомления
-    channel = discord.utils.get(interaction.guild.text_channels, name="💰bidschannel💰")
+    channel = get_channel(interaction.guild, BIDS_CHANNEL)
     if not channel:
-        await interaction.response.send_message("Error: Channel '💰bidschannel💰' not found.", ephemeral=True)
+        await interaction.response.send_message(f"Error: Channel '{BIDS_CHANNEL}' not found.", ephemeral=True)
         return
 
     # Отправляем уведомление
     embed = discord.Embed(
         description=f"## Admin {user.display_name} removed {member.display_name}'s bid from auction ID '{auction_id}'.\n"
-                    f"## {existing_bid['amount']} DKP returned to {member.mention}.",
+                    f"## {existing_amount} DKP returned to {member.mention}.",
         color=discord.Color.red()
     )
 
-    await channel.send(embed=embed)
+    send_message(channel, embed=embed)
     await interaction.response.send_message(
         f"✅ {member.display_name}'s bid has been removed from auction ID '{auction_id}', and their DKP has been refunded.",
         ephemeral=True
     )
         
+def read_auction_log():
+    return read_json_checked(AUC_LOG_FILE, {}) or {"last_id": 0, "auctions": {}}
+
+def write_auction_log(auction_log):
+    write_file_atomic(AUC_LOG_FILE, json.dumps(auction_log, indent=4, ensure_ascii=False))
+
+class AuctionHistory:
+    """История аукционов из auc_log.json в памяти, с индексами.
+
+    В файле записи лежат под ключами "{name}_{id}", поэтому держим индекс
+    by_id {id: ключ} и вторичные индексы by_boss / by_item {имя в нижнем регистре: [id, ...]}.
+    Меняется только в потоке ввода-вывода (через run_io), как и сам файл."""
+
+    def __init__(self, auction_log):
+        self.log = auction_log
+        self.by_id = {}
+        self.by_boss = {}
+        self.by_item = {}
+        self.by_time = []  # [(created_at, id)], отсортирован
+        self.migrated = 0  # Записи, у которых строковые метки времени переведены в epoch
+        for key, record in auction_log["auctions"].items():
+            for field in ("created_at", "date_of_end"):
+                if isinstance(record.get(field), str):
+                    record[field] = to_epoch(record[field])
+                    self.migrated += 1
+            self.index(key, record)
+
+    def index(self, key, record):
+        # В старых записях имени босса может не быть - берем его из ключа
+        boss = record.get("name") or key.rsplit("_", 1)[0]
+        self.by_id[record["id"]] = key
+        self.by_boss.setdefault(boss.lower(), []).append(record["id"])
+        self.by_item.setdefault(str(record.get("item", "")).lower(), []).append(record["id"])
+        bisect.insort(self.by_time, (record.get("created_at", 0), record["id"]))
+
+    def get(self, auction_id):
+        key = self.by_id.get(auction_id)
+        return self.log["auctions"][key] if key is not None else None
+
+    def add(self, auction_name, record):
+        key = f"{auction_name}_{record['id']}"
+        # last_id только растет - ID выдаются из памяти, записи могут прийти не по порядку
+        self.log["last_id"] = max(int(self.log["last_id"]), record["id"])
+        self.log["auctions"][key] = record
+        self.index(key, record)
+
+    def between(self, start, end):
+        """ID аукционов, созданных с start по end (epoch), по времени."""
+        lo = bisect.bisect_left(self.by_time, (start,))
+        hi = bisect.bisect_right(self.by_time, (end, float("inf")))
+        return [auction_id for _, auction_id in self.by_time[lo:hi]]
+
+    def find(self, name):
+        """ID аукционов, где босс или предмет совпадает с name (без учета регистра)."""
+        name = name.lower()
+        return sorted(set(self.by_boss.get(name, [])) | set(self.by_item.get(name, [])))
+
+auction_history = None
+
+def load_auction_history():
+    """История читается из файла один раз, дальше берется из памяти."""
+    global auction_history
+    if auction_history is None:
+        auction_history = AuctionHistory(read_auction_log())
+        # Старый формат с датами-строками сохраняем уже в epoch
+        if auction_history.migrated:
+            write_auction_log(auction_history.log)
+    return auction_history
+
+def append_auction_records(auction_name, records):
+    """Добавляет записи в историю и пишет файл один раз на всю пачку."""
+    history = load_auction_history()
+    for record in records:
+        history.add(auction_name, record)
+    write_auction_log(history.log)
+
+def update_auction_bids(results):
+    """results: {auction_id: bids} - файл пишется один раз на всю пачку."""
+    history = load_auction_history()
+    updated = False
+    for auction_id, bids in results.items():
+        record = history.get(auction_id)
+        if record is not None:
+            record["top_3_bids"] = bids
+            updated = True
+    if updated:
+        write_auction_log(history.log)
+
+def find_auction_record(auction_id):
+    """Запись аукциона из истории (None, если такого ID нет)."""
+    if DKP_STORAGE == "sqlite":
+        return db_auction_record(auction_id)
+    return load_auction_history().get(auction_id)
+
+def find_auction_records(name):
+    """Записи аукционов по имени босса или предмета."""
+    if DKP_STORAGE == "sqlite":
+        return [db_auction_record(auction_id) for auction_id in db_find_auctions(name)]
+    history = load_auction_history()
+    return [history.get(auction_id) for auction_id in history.find(name)]
+
+def find_auctions_between(start, end):
+    """Записи аукционов, созданных с start по end (epoch)."""
+    if DKP_STORAGE == "sqlite":
+        return db_auctions_between(start, end)
+    history = load_auction_history()
+    return [history.get(auction_id) for auction_id in history.between(start, end)]
+
+def allocate_auction_ids(count=1):
+    """Выдает count новых ID аукционов подряд, без чтения истории.
+
+    Между чтением и увеличением счетчика нет await, поэтому параллельные !sauc
+    не получат одинаковый ID. Счетчик сохраняется в снимке active_auctions.json
+    и в last_id истории аукционов."""
+    global last_auction_id
+    first_id = last_auction_id + 1
+    last_auction_id += count
+    mark_auctions_dirty()
+    return list(range(first_id, last_auction_id + 1))
+
+def auction_record(auction_id, auction_name, item, description, end_time):
+    return {
+        "id": auction_id,
+        "name": auction_name,
+        "item": item,
+        "description": description,
+        "created_at": int(time.time()),
+        "date_of_end": int(end_time),
+        "top_3_bids": []  # Заполнится в settle_auctions
+    }
+
+async def log_auction_creations(auction_name, records):
+    """Записывает в лог новые аукционы одной записью."""
+    if DKP_STORAGE == "sqlite":
+        await run_io(db_insert_auctions, records)
+    else:
+        await run_io(append_auction_records, auction_name, records)
+
 async def log_auction_creation(auction_id, auction_name, item, description, end_time):
     """Записывает в лог информацию о новом аукционе."""
-    timestamp = time.strftime("[%Y-%m-%d %H:%M:%S]")
+    await log_auction_creations(auction_name, [auction_record(auction_id, auction_name, item, description, end_time)])
+
+async def log_auction_results(results):
+    """Обновляет лог аукционов, добавляя top 3 bids. results: {auction_id: top_3_bids}."""
+    # Сохраняем только ID пользователей и сумму ставки
+    results = {
+        auction_id: [{"user_id": bid["user"].id, "amount": bid["amount"]} for bid in top_3_bids]
+        for auction_id, top_3_bids in results.items()
+    }
+    if not results:
+        return
 
-    # Загружаем текущие данные из файла
-    if not os.path.exists(AUC_LOG_FILE):
-        auction_log = {"last_id": 0, "auctions": {}}
+    if DKP_STORAGE == "sqlite":
+        await run_io(db_replace_bids, results)
     else:
-        async with aiofiles.open(AUC_LOG_FILE, mode="r") as f:
-            content = await f.read()
-            auction_log = json.loads(content) if content.strip() else {"last_id": 0, "auctions": {}}
+        await run_io(update_auction_bids, results)
 
-    # Обновляем last_id
-    auction_log["last_id"] = auction_id
+def mark_auctions_dirty():
+    """Снимок активных аукционов будет записан при следующем тике auction_snapshot_loop."""
+    global auctions_dirty
+    auctions_dirty = True
 
-    # Добавляем новый аукцион в лог с уникальным идентификатором
-    auction_log["auctions"][f"{auction_name}_{auction_id}"] = {
-        "id": auction_id,
-        "name": auction_name,
-        "item": item,
-        "description": description,
-        "created_at": timestamp,
-        "date_of_end": time.strftime("[%Y-%m-%d %H:%M:%S]", time.localtime(end_time)),
-        "top_3_bids": []  # Заполнится в endauction
+def write_auctions_state(state):
+    write_file_atomic(AUCTIONS_STATE_FILE, json.dumps(state, ensure_ascii=False))
+
+async def flush_auctions_state():
+    global auctions_dirty
+    if not auctions_dirty:
+        return
+    # Копию снимаем на loop, в файл пишем в потоке ввода-вывода
+    started = time.perf_counter()
+    state = {
+        "auctions": {auction_id: {**auction, "bids": auction["bids"].to_list()} for auction_id, auction in auctions.items()},
+        "auction_messages": dict(auction_messages),
+        "last_bid_times": {auction_id: dict(user_times) for auction_id, user_times in last_bid_times.items()},
+        "last_auction_id": last_auction_id,
+        "board_messages": dict(board_messages)
     }
+    record_snapshot_time(started)
+    auctions_dirty = False
+    try:
+        await run_io(write_auctions_state, state)
+    except Exception:
+        auctions_dirty = True
+        raise
+
+@tasks.loop(seconds=AUCTION_SNAPSHOT_INTERVAL)
+async def auction_snapshot_loop():
+    await flush_auctions_state()
+
+def restore_auctions_state():
+    """Загружает снимок активных аукционов, блокировки ставок и ставит таймеры завершения."""
+    global last_auction_id
+    state = read_json_checked(AUCTIONS_STATE_FILE, {})
+
+    # В JSON ключи - строки, ID аукционов и пользователей храним как int
+    for auction_id, auction in state.get("auctions", {}).items():
+        auction["bids"] = BidBook(auction["bids"])
+        auctions[int(auction_id)] = auction
+        for b in auction["bids"]:
+            hold_bid(b["user"], auction["id"], b["amount"])
+        schedule_auction(auction["id"], auction["end_time"])
+    for auction_id, message_id in state.get("auction_messages", {}).items():
+        auction_messages[int(auction_id)] = message_id
+    for auction_id, user_times in state.get("last_bid_times", {}).items():
+        last_bid_times[int(auction_id)] = {int(user_id): ts for user_id, ts in user_times.items()}
+    for guild_id, message_id in state.get("board_messages", {}).items():
+        board_messages[int(guild_id)] = message_id
+    # Доски перерисуем после подключения: за время простоя аукционы могли завершиться
+    for auction in auctions.values():
+        request_board_update(auction["guild_id"])
+    # ID могли быть выданы, но не попасть в историю до остановки - счетчик только растет
+    last_auction_id = max([last_auction_id, state.get("last_auction_id", 0), *auctions])
+    print(f"[AUC] Восстановлено активных аукционов: {len(auctions)}")
+
+def schedule_auction(auction_id, end_time):
+    """Ставит (или переносит) завершение аукциона. Старые записи в куче отбрасываются при извлечении."""
+    heapq.heappush(auction_heap, (end_time, auction_id))
+    auction_wakeup.set()
+
+async def auction_scheduler():
+    """Одна задача на все аукционы: спит ровно до ближайшего end_time."""
+    await bot.wait_until_ready()
+    while True:
+        # Аукционы, истекшие в один тик, завершаем одной пачкой
+        due = {}
+        while auction_heap:
+            end_time, auction_id = auction_heap[0]
+            auction = auctions.get(auction_id)
+            # Аукцион уже завершен или его время продлили (в куче есть более поздняя запись)
+            if auction is None or auction["end_time"] != end_time:
+                heapq.heappop(auction_heap)
+                continue
+            now = time.time()
+            if end_time > now:
+                break
+            heapq.heappop(auction_heap)
 
-    # Сохраняем изменения в файл
-    async with aiofiles.open(AUC_LOG_FILE, mode="w") as f:
-        await f.write(json.dumps(auction_log, indent=4, ensure_ascii=False))
+            lag = now - end_time
+            settle_lag_stats["count"] += 1
+            settle_lag_stats["total"] += lag
+            settle_lag_stats["max"] = max(settle_lag_stats["max"], lag)
+            settle_lag_stats["last"] = lag
+            due.setdefault(auction["guild_id"], []).append(auction_id)
 
-async def log_auction_result(auction_id, top_3_bids):
-    """Обновляет лог аукциона, добавляя top 3 bids."""
-    if not os.path.exists(AUC_LOG_FILE):
-        return
+        for guild_id, auction_ids in due.items():
+            try:
+                await settle_auctions(bot.get_guild(guild_id), auction_ids)
+            except Exception as e:
+                print(f"[ERROR] Не удалось завершить аукционы {auction_ids}: {e}")
+        if due:
+            continue
+
+        auction_wakeup.clear()
+        timeout = auction_heap[0][0] - time.time() if auction_heap else None
+        try:
+            await asyncio.wait_for(auction_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def request_board_update(guild_id):
+    """Помечает доску сервера для перерисовки; частые ставки сливаются в одно редактирование."""
+    board_dirty.add(guild_id)
+    board_wakeup.set()
+
+def render_board(guild_id):
+    guild_auctions = sorted((auc for auc in auctions.values() if auc["guild_id"] == guild_id), key=lambda auc: auc["end_time"])
+    lines = []
+    for auction in guild_auctions:
+        leader = f"<@{auction['highest_bidder']}>" if auction["highest_bidder"] else "no bids"
+        # Обратный отсчет Discord показывает сам, редактировать ради него не нужно
+        lines.append(f"**{auction['id']}** - {auction['item']}: **{auction['highest_bid']} DKP** ({leader}), ends <t:{int(auction['end_time'])}:R>")
+    description = "\n".join(lines) or "No active auctions."
+    if len(description) > 4000:  # Лимит описания embed - 4096 символов
+        description = description[:4000].rsplit("\n", 1)[0] + "\n..."
+    return discord.Embed(
+        title="Live auctions",
+        description=description + "\n\nTo place a bid, use the command: __/bid ID amount__.",
+        color=discord.Color.green()
+    )
 
-    # Загружаем текущий лог аукционов
-    async with aiofiles.open(AUC_LOG_FILE, mode="r") as f:
-        content = await f.read()
-        auction_log = json.loads(content) if content.strip() else {"last_id": 0, "auctions": {}}
-
-    # Проверяем, что аукцион с данным ID существует
-    for auction_name, auction_data in auction_log["auctions"].items():
-        if auction_data["id"] == auction_id:
-            # Обновляем данные top_3_bids, сохраняем только ID пользователей и сумму ставки
-            auction_data["top_3_bids"] = [
-                {"user_id": bid["user"].id, "amount": bid["amount"]} for bid in top_3_bids
-            ]
-            
-            # Сохраняем обновленный лог
-            async with aiofiles.open(AUC_LOG_FILE, mode="w") as f:
-                await f.write(json.dumps(auction_log, indent=4, ensure_ascii=False))
-            break
+async def update_board(guild_id):
+    """Перерисовывает доску. False - правку отбросила перегруженная очередь канала."""
+    guild = bot.get_guild(guild_id)
+    channel = get_channel(guild, BIDS_CHANNEL) if guild else None
+    if not channel:
+        return True
+    embed = render_board(guild_id)
+    message_id = board_messages.get(guild_id)
+    if message_id:
+        # При перегрузке канала правка не встает в очередь - повторим ее позже
+        try:
+            result = await edit_message(channel, message_id, key="board", droppable=True, embed=embed)
+            return result is not OUTBOX_DROPPED
+        except discord.NotFound:
+            pass  # Доску удалили - публикуем заново
+    message = await send_message(channel, embed=embed)
+    board_messages[guild_id] = message.id
+    mark_auctions_dirty()
+    return True
+
+async def auction_board_loop():
+    """Перерисовывает помеченные доски, не чаще BOARD_EDITS_PER_SECOND редактирований в секунду."""
+    await bot.wait_until_ready()
+    interval = 1 / BOARD_EDITS_PER_SECOND
+    while True:
+        await board_wakeup.wait()
+        board_wakeup.clear()
+        while board_dirty:
+            guild_id = board_dirty.pop()
+            try:
+                # Доска - единственная публичная запись ставок: отброшенную правку не теряем,
+                # а повторяем после паузы
+                if not await update_board(guild_id):
+                    board_dirty.add(guild_id)
+            except Exception as e:
+                print(f"[ERROR] Не удалось обновить доску аукционов: {e}")
+            # Ставки, пришедшие за паузу, попадут в следующее редактирование
+            await asyncio.sleep(interval)
+
+# Статистика планировщика аукционов
+@bot.command()
+@commands.has_any_role('Leader')
+async def aucstats(ctx):
+    """Shows how late auctions are settled relative to their end time."""
+    count = settle_lag_stats["count"]
+    avg_lag = settle_lag_stats["total"] / count if count else 0.0
+    next_end = min((auc["end_time"] for auc in auctions.values()), default=None)
+    next_info = format_seconds(max(0, next_end - time.time())) if next_end else "—"
+    await ctx.send(
+        f"**⏱️ Auction scheduler:**\n"
+        f"Active auctions: {len(auctions)} (timers in queue: {len(auction_heap)})\n"
+        f"Next end in: {next_info}\n"
+        f"Settled: {count} | lag avg {avg_lag:.3f}s, max {settle_lag_stats['max']:.3f}s, last {settle_lag_stats['last']:.3f}s"
+    )
 
 # Функция для старта аукциона с уникальным именем
 @bot.command()
@@ -448,14 +1997,14 @@ async def sauc(ctx, auction_name: str, item: str, description: str, duration: in
         await ctx.send(f"Auction with the name '{auction_name}' already exists.")
         return
 
-    # Загружаем текущие данные из лога
-    if not os.path.exists(AUC_LOG_FILE):
-        auction_id = 1
-    else:
-        async with aiofiles.open(AUC_LOG_FILE, mode="r") as f:
-            content = await f.read()
-            auction_log = json.loads(content) if content.strip() else {"last_id": 0, "auctions": {}}
-            auction_id = int(auction_log["last_id"]) + 1  # Преобразуем last_id в целое число
+    # Получаем канал по имени; без него аукцион не открываем
+    channel = get_channel(ctx.guild, LIVE_AUCTIONS_CHANNEL)
+    if not channel:
+        await ctx.send(f"Error: Channel '{LIVE_AUCTIONS_CHANNEL}' not found.")
+        return  # ❗ Важно: остановить если нет канала
+
+    # Новый ID выдаем из памяти, историю не читаем
+    auction_id, = allocate_auction_ids()
 
     end_time = time.time() + duration
 
@@ -466,231 +2015,213 @@ async def sauc(ctx, auction_name: str, item: str, description: str, duration: in
     "description": description,
     "highest_bid": 0,
     "highest_bidder": None,
-    "bids": [],
-    "end_time": end_time
+    "bids": BidBook(),
+    "end_time": end_time,
+    "guild_id": ctx.guild.id
     }
+    # Аукцион уже принимает ставки - ставим его в планировщик сразу, чтобы он завершился,
+    # даже если запись истории или объявление ниже упадут
+    schedule_auction(auction_id, end_time)
+    mark_auctions_dirty()
+    request_board_update(ctx.guild.id)
 
     # Логируем создание аукциона
     await log_auction_creation(auction_id, auction_name, item, description, end_time)
-    
-    # Получаем канал по имени (замените на свой канал)
-    channel = discord.utils.get(ctx.guild.text_channels, name="📢liveauctions📢")
-    
-    # Проверяем, найден ли канал
-    if channel:
-        # Отправляем сообщение в канал #auctions1
-        embed = discord.Embed(
-        title=f"Auction boss: {auction_name} (__ID: {auction_id}__)",
-        description=f"# @everyone, the auction has started!\n"
-                f"## Item: {item}\n"
-                f"## Trait: {description}\n"
-                f"### Bids are accepted for __{format_seconds(duration)}__.\n"
-                f"### To place a bid, use the command: __/bid {auction_id} amount__.",
-        color=discord.Color.random()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
-        )
-        # Отправляем сообщение в канал #auctions1 с встраиваемым сообщением
-        auction_message = await channel.send(embed=embed)
-        auction_messages[auction_id] = auction_message.id
-    else:
-        await ctx.send("Error: Channel '#auctions1' not found.")
-        return  # ❗ Важно: остановить если нет канала
-
-    # 🛡 Только после ВСЕХ записей запускаем фонового следящего
-    async def auction_watcher():
-        while True:
-            await asyncio.sleep(5)  # сначала спим, чтобы не дергать каждый тик
-            now = time.time()
-            if auction_id not in auctions:
-                break  # если аукцион удалили вручную
-            if now >= auctions[auction_id]["end_time"]:
-                await endauction(ctx, auction_id)
-                break
-
-    bot.loop.create_task(auction_watcher())
 
-# Функция для окончания аукциона с уникальным именем
-async def endauction(ctx, auction_id: int):
-    """Ends the auction, announces the winner, the runner-up, and deducts DKP."""
+    # Отправляем сообщение в канал #auctions1
+    embed = discord.Embed(
+    title=f"Auction boss: {auction_name} (__ID: {auction_id}__)",
+    description=f"# @everyone, the auction has started!\n"
+            f"## Item: {item}\n"
+            f"## Trait: {description}\n"
+            f"### Bids are accepted for __{format_seconds(duration)}__.\n"
+            f"### To place a bid, use the command: __/bid {auction_id} amount__.",
+    color=discord.Color.random()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
+    )
+    # Отправляем сообщение в канал #auctions1 с встраиваемым сообщением
+    auction_message = await send_message(channel, embed=embed)
+    auction_messages[auction_id] = auction_message.id
+    mark_auctions_dirty()
+
+def parse_loot_table(text):
+    """Строки "предмет | трейт" (трейт можно не указывать), пустые строки пропускаются."""
+    items = []
+    for line in text.splitlines():
+        item, _, description = line.partition("|")
+        if item.strip():
+            items.append((item.strip(), description.strip()))
+    return items
+
+# Функция для запуска аукционов на весь дроп с босса одной командой
+@bot.command()
+@commands.has_any_role('Leader')
+async def bsauc(ctx, auction_name: str, duration: int, *, loot: str = ""):
+    """Starts auctions for a whole loot table: one "item | trait" per line, inline or in an attached .txt file."""
     global auctions
 
-    # Проверяем, существует ли аукцион с таким ID
-    auction = next((auc for auc in auctions.values() if auc["id"] == auction_id), None)
-    channel = discord.utils.get(ctx.guild.text_channels, name="🏆auctionsresult🏆")
-
-    if not auction:
-        await ctx.send(f"No auction found with ID {auction_id}.")
+    if ctx.message.attachments:
+        loot += "\n" + (await ctx.message.attachments[0].read()).decode("utf-8")
+    items = parse_loot_table(loot)
+    if not items:
+        await ctx.send("Usage: !bsauc <name> <duration> followed by one \"item | trait\" per line (or attach a .txt file).")
         return
 
-    # Если ставки были, проводим расчет победителя
-    if auction["highest_bidder"]:
-        winner_id = auction["highest_bidder"]
-        dkp_data = await load_dkp_data()
-
-        # Убедимся, что у пользователя есть валидный баланс DKP
-        user_data = dkp_data.get(str(winner_id))
-        if user_data:
-            user_dkp = user_data["dkp"]
-            if isinstance(user_dkp, int):  # Проверим, что DKP является целым числом
-                new_dkp = max(0, user_dkp - auction["highest_bid"])
-                dkp_data[str(winner_id)]["dkp"] = new_dkp
-            else:
-                await channel.send(f"Error: Invalid DKP value for {winner_id}.")
-                return
+    channel = get_channel(ctx.guild, LIVE_AUCTIONS_CHANNEL)
+    if not channel:
+        await ctx.send(f"Error: Channel '{LIVE_AUCTIONS_CHANNEL}' not found.")
+        return
 
-            await save_dkp_data(dkp_data)
+    # ID на всю пачку выдаем одним шагом, историю пишем один раз
+    end_time = time.time() + duration
+    auction_ids = allocate_auction_ids(len(items))
+    records = []
+    for auction_id, (item, description) in zip(auction_ids, items):
+        auctions[auction_id] = {
+        "id": auction_id,
+        "item": item,
+        "description": description,
+        "highest_bid": 0,
+        "highest_bidder": None,
+        "bids": BidBook(),
+        "end_time": end_time,
+        "guild_id": ctx.guild.id
+        }
+        records.append(auction_record(auction_id, auction_name, item, description, end_time))
+        # Аукцион уже принимает ставки - ставим его в планировщик сразу, чтобы он завершился,
+        # даже если запись истории или объявление ниже упадут
+        schedule_auction(auction_id, end_time)
+    mark_auctions_dirty()
+    request_board_update(ctx.guild.id)
+    await log_auction_creations(auction_name, records)
+
+    # Одно объявление на весь дроп: по 20 предметов в embed, по 3 embed в сообщении
+    # (в сообщении Discord не больше 6000 символов во всех embed)
+    lines = [f"**{auction_id}** - {item}" + (f" ({description})" if description else "") for auction_id, (item, description) in zip(auction_ids, items)]
+    embeds = []
+    for start in range(0, len(lines), 20):
+        embeds.append(discord.Embed(description="\n".join(lines[start:start + 20]), color=discord.Color.random()))
+    embeds[0].title = f"Auction boss: {auction_name} ({len(items)} items)"
+    embeds[0].description = (
+        f"# @everyone, the auctions have started!\n"
+        f"### Bids are accepted for __{format_seconds(duration)}__.\n"
+        f"### To place a bid, use the command: __/bid ID amount__.\n" + embeds[0].description
+    )
+    message_ids = []
+    try:
+        for start in range(0, len(embeds), 3):
+            message = await send_message(channel, embeds=embeds[start:start + 3])
+            message_ids.append(message.id)
+    finally:
+        # Все аукционы ссылаются на объявление, в котором они перечислены (если оно успело уйти)
+        for index, auction_id in enumerate(auction_ids[:len(message_ids) * 60]):
+            auction_messages[auction_id] = message_ids[index // 60]
+        mark_auctions_dirty()
+
+async def delete_auction_message(guild, auction_id):
+    """Удаляет объявление аукциона, если на него не ссылаются другие активные аукционы (!bsauc)."""
+    auction_message_id = auction_messages.pop(auction_id, None)
+    if not auction_message_id or auction_message_id in auction_messages.values():
+        return
+    channel = get_channel(guild, LIVE_AUCTIONS_CHANNEL)
+    # После рестарта сообщение находим по сохраненному ID, без fetch_message
+    delete_message(channel, auction_message_id)
+
+async def settle_auctions(guild, auction_ids):
+    """Завершает пачку аукционов: объявляет победителей и списывает DKP.
+
+    Все списания идут одной транзакцией DKP, результаты пишутся в историю за один раз,
+    итоги уходят одним сообщением (до 10 embed в сообщении). Используется и планировщиком,
+    и !fendauc."""
+    batch = [auctions.pop(auction_id) for auction_id in auction_ids if auction_id in auctions]
+    if not batch:
+        return
+    # Аукционы сняты с торгов сразу: новые ставки на них уже не принимаются
+    for auction in batch:
+        last_bid_times.pop(auction["id"], None)
+        request_board_update(auction["guild_id"])
+    mark_auctions_dirty()
+
+    # Победителей и топ-3 всех аукционов получаем одним запросом
+    top_bids = {auction["id"]: auction["bids"].top(3) for auction in batch}
+    user_ids = {b["user"] for bids in top_bids.values() for b in bids}
+    user_ids.update(auction["highest_bidder"] for auction in batch if auction["highest_bidder"])
+    bidders = await resolve_users(guild, list(user_ids))
 
-            winner = await bot.fetch_user(winner_id)
-            
-             # Логируем изменение DKP
-            description = f"winner of auction ID {auction_id}"
-            await log_dkp_change(winner, auction['highest_bid'], "Remove", description)  # Логирование
-
-            # Определяем топ-3 ставки
-            sorted_bids = sorted(auction["bids"], key=lambda b: b["amount"], reverse=True)
-            top_3_bids = [
-                {"user": await bot.fetch_user(b["user"]), "amount": b["amount"]}
-                for b in sorted_bids[:3]
-            ]
-
-            # Логируем результаты
-            await log_auction_result(auction_id, top_3_bids)
-            
-            #Формируем финальное сообщение
-            result_message = f"## Winner: **{winner.mention}** with a bid of {auction['highest_bid']} DKP.\n"
-
-            if len(top_3_bids) > 1:
-                runner_up = ctx.guild.get_member(top_3_bids[1]["user"].id)
-                runner_up_bid = top_3_bids[1]["amount"]
-                result_message += f"### Second bid: **{runner_up.display_name}** with a bid of {runner_up_bid} DKP.\n"
-
-            if len(top_3_bids) > 2:
-                third_place = ctx.guild.get_member(top_3_bids[2]["user"].id)
-                third_place_bid = top_3_bids[2]["amount"]
-                result_message += f"### Third bid: **{third_place.display_name}** with a bid of {third_place_bid} DKP.\n"
-            
-            embed = discord.Embed(
-                description=f"# @everyone, the auction with ID **{auction_id}** for item **{auction['item']}: {auction['description']}** has ended!\n{result_message}",
-                color=discord.Color.random()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
-            )
-            
-            await channel.send(embed=embed)
+    dkp_data = await load_dkp_data()
+    changes = []
+    results = {}
+    embeds = []
+    for auction in batch:
+        auction_id = auction["id"]
+        winner_id = auction["highest_bidder"]
 
-        else:
-            embed = discord.Embed(
-                title=f"Error",
-                description=f"No DKP data for winner with ID {winner_id}.",
-                color=discord.Color.red()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
-            )
-            await channel.send(embed=embed)
-    else:
-        embed = discord.Embed(
+        # Если ставок не было
+        if not winner_id:
+            embeds.append(discord.Embed(
                 description=f"# @everyone, the auction with ID **{auction_id}** (item: {auction['item']}: {auction['description']}) has ended\n"
                             f"## But no bids were placed.",
-                color=discord.Color.red()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
-            )
-        await channel.send(embed=embed)
-
-    # Удаляем сообщение о старте аукциона
-    channel = discord.utils.get(ctx.guild.text_channels, name="📢liveauctions📢")
-    auction_message_id = auction_messages.get(auction_id)
-    if auction_message_id:
-        auction_message = await channel.fetch_message(auction_message_id)
-        await auction_message.delete()
-    # Удаляем аукцион из списка
-    del auctions[auction_id]
-
-# Функция для принудительной остановки аукциона с уникальным именем
-@bot.command()
-@commands.has_any_role('Leader')
-async def fendauc(ctx, auction_id: int):
-    """Ends the auction, announces the winner, the runner-up, and deducts DKP."""
-    global auctions
-
-    # Проверяем, существует ли аукцион с таким ID
-    auction = next((auc for auc in auctions.values() if auc["id"] == auction_id), None)
-    channel = discord.utils.get(ctx.guild.text_channels, name="🏆auctionsresult🏆")
-
-    if not auction:
-        await ctx.send(f"No auction found with ID {auction_id}.")
-        return
-
-    # Если ставки были, проводим расчет победителя
-    if auction["highest_bidder"]:
-        winner_id = auction["highest_bidder"]
-        dkp_data = await load_dkp_data()
+                color=discord.Color.red()
+            ))
+            continue
 
         # Убедимся, что у пользователя есть валидный баланс DKP
         user_data = dkp_data.get(str(winner_id))
-        if user_data:
-            user_dkp = user_data["dkp"]
-            if isinstance(user_dkp, int):  # Проверим, что DKP является целым числом
-                new_dkp = max(0, user_dkp - auction["highest_bid"])
-                dkp_data[str(winner_id)]["dkp"] = new_dkp
-            else:
-                await channel.send(f"Error: Invalid DKP value for {winner_id}.")
-                return
-
-            await save_dkp_data(dkp_data)
-
-            winner = await bot.fetch_user(winner_id)
-            
-             # Логируем изменение DKP
-            description = f"winner of auction ID {auction_id}"
-            await log_dkp_change(winner, auction['highest_bid'], "Remove", description)  # Логирование
-
-            # Определяем топ-3 ставки
-            sorted_bids = sorted(auction["bids"], key=lambda b: b["amount"], reverse=True)
-            top_3_bids = [
-                {"user": await bot.fetch_user(b["user"]), "amount": b["amount"]}
-                for b in sorted_bids[:3]
-            ]
-
-            # Логируем результаты
-            await log_auction_result(auction_id, top_3_bids)
-            
-            #Формируем финальное сообщение
-            result_message = f"## Winner: **{winner.mention}** with a bid of {auction['highest_bid']} DKP.\n"
-
-            if len(top_3_bids) > 1:
-                runner_up = ctx.guild.get_member(top_3_bids[1]["user"].id)
-                runner_up_bid = top_3_bids[1]["amount"]
-                result_message += f"### Second bid: **{runner_up.display_name}** with a bid of {runner_up_bid} DKP.\n"
-
-            if len(top_3_bids) > 2:
-                third_place = ctx.guild.get_member(top_3_bids[2]["user"].id)
-                third_place_bid = top_3_bids[2]["amount"]
-                result_message += f"### Third bid: **{third_place.display_name}** with a bid of {third_place_bid} DKP.\n"
-            
-            embed = discord.Embed(
-                description=f"# @everyone, the auction with ID **{auction_id}** for item **{auction['item']}** has ended!\n{result_message}",
-                color=discord.Color.random()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
-            )
-            
-            await channel.send(embed=embed)
-
-        else:
-            embed = discord.Embed(
+        if not user_data or not isinstance(user_data["dkp"], int):
+            embeds.append(discord.Embed(
                 title=f"Error",
-                description=f"No DKP data for winner with ID {winner_id}.",
-                color=discord.Color.red()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
-            )
-            await channel.send(embed=embed)
-    else:
-        embed = discord.Embed(
-                description=f"# @everyone, the auction with ID **{auction_id}** (item: {auction['item']}) has ended\n"
-                            f"## But no bids were placed.",
-                color=discord.Color.red()  # Можно заменить на любой цвет, например, red, blue, purple и т. д.
-            )
-        await channel.send(embed=embed)
+                description=f"No valid DKP data for winner with ID {winner_id} (auction ID {auction_id}).",
+                color=discord.Color.red()
+            ))
+            continue
+
+        winner = bidders[winner_id]
+        top_3_bids = [
+            {"user": bidders[b["user"]] or discord.Object(id=b["user"]), "amount": b["amount"]}
+            for b in top_bids[auction_id]
+        ]
+        changes.append((winner or discord.Object(id=winner_id), auction["highest_bid"], "Remove", f"winner of auction ID {auction_id}"))
+        results[auction_id] = top_3_bids
+
+        #Формируем финальное сообщение
+        result_message = f"## Winner: **<@{winner_id}>** with a bid of {auction['highest_bid']} DKP.\n"
+        if len(top_3_bids) > 1:
+            result_message += f"### Second bid: **{member_name(bidders[top_3_bids[1]['user'].id])}** with a bid of {top_3_bids[1]['amount']} DKP.\n"
+        if len(top_3_bids) > 2:
+            result_message += f"### Third bid: **{member_name(bidders[top_3_bids[2]['user'].id])}** with a bid of {top_3_bids[2]['amount']} DKP.\n"
+        embeds.append(discord.Embed(
+            description=f"# @everyone, the auction with ID **{auction_id}** for item **{auction['item']}: {auction['description']}** has ended!\n{result_message}",
+            color=discord.Color.random()
+        ))
+
+    # Списываем DKP всех победителей одной транзакцией и пишем результаты в историю
+    # (блокировки ставок снимаем только после списания, чтобы эти DKP нельзя было поставить еще раз)
+    try:
+        if changes:
+            await apply_dkp_changes(changes)
+        await log_auction_results(results)
+    finally:
+        for auction in batch:
+            release_auction_holds(auction)
+
+    channel = get_channel(guild, RESULTS_CHANNEL)
+    for start in range(0, len(embeds), 10):
+        send_message(channel, embeds=embeds[start:start + 10], priority=OUTBOX_HIGH)
+
+    # Удаляем сообщения о старте аукционов
+    for auction in batch:
+        await delete_auction_message(guild, auction["id"])
+
+# Функция для принудительной остановки аукционов по ID
+@bot.command()
+@commands.has_any_role('Leader')
+async def fendauc(ctx, *auction_ids: int):
+    """Ends the auctions, announces the winners, the runners-up, and deducts DKP."""
+    missing = [auction_id for auction_id in auction_ids if auction_id not in auctions]
+    if missing or not auction_ids:
+        await ctx.send(f"No auction found with ID {', '.join(map(str, missing)) or '?'}.")
+        return
 
-    # Удаляем сообщение о старте аукциона
-    channel = discord.utils.get(ctx.guild.text_channels, name="📢liveauctions📢")
-    auction_message_id = auction_messages.get(auction_id)
-    if auction_message_id:
-        auction_message = await channel.fetch_message(auction_message_id)
-        await auction_message.delete()
-    # Удаляем аукцион из списка
-    del auctions[auction_id]
+    await settle_auctions(ctx.guild, list(auction_ids))
 
 # Функция для просмотра всех активных аукционов
 @bot.tree.command(name="aucs", description="Shows all list of active auctions")
@@ -711,18 +2242,14 @@ async def aucs(interaction: discord.Interaction):
 
     for idx, chunk in enumerate(chunks, start=1):
         message = f"**🎯 Active Auctions (Page {idx}/{len(chunks)}):**\n"
+        bidders = await resolve_users(interaction.guild, [auc["highest_bidder"] for _, auc in chunk if auc.get("highest_bidder")])
         for auction_id, auction in chunk:
             remaining_time = auction["end_time"] - time.time()
             highest_bid = auction.get("highest_bid", 0)
             highest_bidder_id = auction.get("highest_bidder")
 
             if highest_bidder_id:
-                try:
-                    highest_bidder = await bot.fetch_user(highest_bidder_id)
-                    member = interaction.guild.get_member(highest_bidder_id)
-                    bidder_name = member.display_name if member else "Unknown"
-                except:
-                    bidder_name = "Unknown"
+                bidder_name = member_name(bidders[highest_bidder_id])
                 bid_info = f" | 💰 Highest Bid: **{highest_bid} DKP** by **{bidder_name}**"
             else:
                 bid_info = " | 💰 No bids yet"
@@ -733,88 +2260,374 @@ async def aucs(interaction: discord.Interaction):
             )
 
         # Отправляем страницу
-        await interaction.followup.send(message, ephemeral=True)
-
-
-
-async def log_dkp_change(user, amount, action, description=""):
-    """Логирование изменений DKP в файл dkp_log.json с добавлением описания."""
-    log_file = "dkp_log.json"
-    user_id = str(user.id)
-    timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    log_entry = {
-        "timestamp": timestamp,
-        "action": action.capitalize(),
-        "amount": amount,
-        "description": description
-    }
-
-    try:
-        # Проверяем существование файла
-        if not os.path.exists(log_file):
-            dkp_log = {}  # Создаем новый словарь, если файла нет
+        send_message(interaction.followup, message, ephemeral=True, priority=OUTBOX_HIGH)
+
+
+
+def write_dkp_log_lines(entries):
+    """Дописывает записи в конец dkp_log.jsonl, возвращает смещение каждой строки."""
+    lines = [(json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8") for entry in entries]
+    with open(DKP_EVENTS_FILE, "ab") as f:
+        offset = f.tell()
+        f.write(b"".join(lines))
+    offsets = []
+    for line in lines:
+        offsets.append(offset)
+        offset += len(line)
+    return offsets
+
+async def append_dkp_log_entries(entries):
+    """Дописывает записи в dkp_log.jsonl одной записью в файл и обновляет индекс."""
+    async with dkp_log_lock:
+        entries = dkp_log_backlog + entries
+        try:
+            offsets = await run_io(write_dkp_log_lines, entries)
+        except Exception:
+            dkp_log_backlog[:] = entries
+            raise
+        dkp_log_backlog.clear()
+        for entry, offset in zip(entries, offsets):
+            dkp_log_index.add(entry, offset)
+
+def read_user_totals(offsets):
+    totals = {}
+    for entry in read_dkp_log_entries(offsets):
+        totals[entry["action"]] = totals.get(entry["action"], 0) + entry["amount"]
+    return totals
+
+async def user_dkp_totals(user_id, start=None, end=None):
+    """Сколько DKP пользователь получил и потратил за период (epoch): {"earned": ..., "spent": ...}.
+
+    Читаются только записи пользователя из периода - границы находятся по индексу времени."""
+    if DKP_STORAGE == "sqlite":
+        totals = await run_io(db_user_totals, str(user_id), start, end)
+    else:
+        totals = await run_io(read_user_totals, dkp_log_index.between(str(user_id), start, end))
+    earned = sum(amount for action, amount in totals.items() if action.startswith("Add"))
+    return {"earned": earned, "spent": sum(totals.values()) - earned}
+
+def replay_dkp_entries(balances, entries):
+    """Доигрывает записи лога поверх balances {user_id: dkp}.
+
+    Новые записи хранят баланс после изменения ("balance") - он берется как есть; для старых
+    баланс пересчитывается по сумме так же, как в dkp_mutation."""
+    for entry in entries:
+        user_id = entry["user_id"]
+        if entry.get("balance") is not None:
+            balances[user_id] = entry["balance"]
+        elif entry["action"] == "Added":
+            balances[user_id] = balances.get(user_id, 0) + entry["amount"]
         else:
-            async with aiofiles.open(log_file, mode="r") as f:
-                content = await f.read()
-                dkp_log = json.loads(content) if content.strip() else {}
-
-        # Обновляем логи пользователя
-        if user_id not in dkp_log:
-            dkp_log[user_id] = {
-                "display_name": user.display_name,
-                "logs": []
-            }
-
-        dkp_log[user_id]["logs"].append(log_entry)
-
-        # Записываем обновленный лог в файл
-        async with aiofiles.open(log_file, mode="w") as f:
-            await f.write(json.dumps(dkp_log, indent=4, ensure_ascii=False))
-
-        print(f"[LOG] Успешно записан лог: {log_entry}")
+            balances[user_id] = max(0, balances.get(user_id, 0) - entry["amount"])
+    return balances
+
+def load_dkp_checkpoints():
+    """Читает время последней контрольной точки; для JSON - еще и индекс точек по времени.
+    Точки, которые ссылаются дальше конца лога (лог не успел записаться до падения), отбрасываются."""
+    if DKP_STORAGE == "sqlite":
+        checkpoint_state["timestamp"] = db_last_checkpoint_time()
+        return
+    dkp_checkpoints.clear()
+    log_size = os.path.getsize(DKP_EVENTS_FILE) if os.path.exists(DKP_EVENTS_FILE) else 0
+    try:
+        with open(DKP_CHECKPOINTS_FILE, "rb") as f, open_dkp_log() as log:
+            offset = 0
+            for line in f:
+                try:
+                    checkpoint = json.loads(line)
+                    if checkpoint["log_offset"] <= log_size and at_line_start(log, checkpoint["log_offset"]):
+                        dkp_checkpoints.append((checkpoint["timestamp"], offset))
+                except (json.JSONDecodeError, KeyError):
+                    pass
+                offset += len(line)
+    except FileNotFoundError:
+        pass
+    checkpoint_state["timestamp"] = dkp_checkpoints[-1][0] if dkp_checkpoints else 0
+
+def open_dkp_log():
+    """dkp_log.jsonl для чтения; если лога нет - пустой поток."""
+    try:
+        return open(DKP_EVENTS_FILE, "rb")
+    except FileNotFoundError:
+        return io.BytesIO()
+
+def at_line_start(log, offset):
+    """Смещение указывает на начало строки лога (иначе точка записана для другой версии файла)."""
+    if offset == 0:
+        return True
+    log.seek(offset - 1)
+    return log.read(1) == b"\n"
+
+def remap_dkp_checkpoints(moved, log_size):
+    """После перезаписи лога переносит смещения точек: точка ссылается на первую сохраненную
+    строку, которая в старом файле шла не раньше ее смещения. moved - [(старое, новое смещение)]."""
+    try:
+        with open(DKP_CHECKPOINTS_FILE, "rb") as f:
+            checkpoints = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return
+    except json.JSONDecodeError:
+        reset_dkp_checkpoints()
+        return
+    old_offsets = [old for old, _ in moved]
+    for checkpoint in checkpoints:
+        i = bisect.bisect_left(old_offsets, checkpoint["log_offset"])
+        checkpoint["log_offset"] = moved[i][1] if i < len(moved) else log_size
+    write_file_atomic(DKP_CHECKPOINTS_FILE, "".join(json.dumps(checkpoint) + "\n" for checkpoint in checkpoints))
+    load_dkp_checkpoints()
+
+def reset_dkp_checkpoints():
+    """Лог заменен другим (восстановление из резерва) - старые точки к нему не относятся,
+    следующая запись создаст новую."""
+    if os.path.exists(DKP_CHECKPOINTS_FILE):
+        os.remove(DKP_CHECKPOINTS_FILE)
+    dkp_checkpoints.clear()
+    checkpoint_state["timestamp"] = 0
+
+def write_dkp_checkpoint(timestamp, balances):
+    """Дописывает контрольную точку: балансы и размер лога, до которого они посчитаны."""
+    log_offset = os.path.getsize(DKP_EVENTS_FILE) if os.path.exists(DKP_EVENTS_FILE) else 0
+    line = json.dumps({"timestamp": timestamp, "log_offset": log_offset, "balances": balances}) + "\n"
+    with open(DKP_CHECKPOINTS_FILE, "ab") as f:
+        offset = f.tell()
+        f.write(line.encode("utf-8"))
+    dkp_checkpoints.append((timestamp, offset))
+
+def read_dkp_checkpoint(timestamp):
+    """Последняя контрольная точка не позже timestamp или None."""
+    i = bisect.bisect_right(dkp_checkpoints, (timestamp, float("inf")))
+    if not i:
+        return None
+    with open(DKP_CHECKPOINTS_FILE, "rb") as f:
+        f.seek(dkp_checkpoints[i - 1][1])
+        return json.loads(f.readline())
+
+def iter_dkp_log_from(offset):
+    with open(DKP_EVENTS_FILE, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+def read_balances_at(timestamp, user_id=None):
+    """JSON-хранилище: балансы на момент timestamp по ближайшей контрольной точке и логу после нее."""
+    checkpoint = read_dkp_checkpoint(timestamp)
+    balances = checkpoint["balances"] if checkpoint else {}
+    log_offset = checkpoint["log_offset"] if checkpoint else 0
+    if user_id is not None:
+        # Записи пользователя после точки находим по индексу: смещения идут по порядку файла
+        offsets = dkp_log_index.offsets.get(user_id, [])
+        lo = bisect.bisect_left(offsets, log_offset)
+        _, hi = dkp_log_index.range(user_id, None, timestamp)
+        entries = read_dkp_log_entries(offsets[lo:hi]) if lo < hi else []
+        return replay_dkp_entries({user_id: balances.get(user_id, 0)}, entries)
+    if not os.path.exists(DKP_EVENTS_FILE):
+        return balances
+    entries = itertools.takewhile(lambda entry: entry.get("timestamp", 0) <= timestamp, iter_dkp_log_from(log_offset))
+    return replay_dkp_entries(balances, (entry for entry in entries if "user_id" in entry))
+
+def db_checkpoint_before(timestamp):
+    row = db_conn.execute("SELECT MAX(timestamp) FROM checkpoints WHERE timestamp <= ?", (timestamp,)).fetchone()
+    return row[0]
+
+async def dkp_checkpoint_before(timestamp):
+    """Время ближайшей контрольной точки не позже timestamp или None - тогда баланс на эту дату
+    считается доигрыванием лога с нуля и не учитывает изменения, не попавшие в лог."""
+    if DKP_STORAGE == "sqlite":
+        return await run_io(db_checkpoint_before, timestamp)
+    i = bisect.bisect_right(dkp_checkpoints, (timestamp, float("inf")))
+    return dkp_checkpoints[i - 1][0] if i else None
+
+async def dkp_balances_at(timestamp, user_id=None):
+    """Балансы DKP на момент timestamp (epoch): {user_id: dkp} всей гильдии или одного user_id.
+
+    Читается ближайшая контрольная точка до timestamp и доигрываются только записи лога после нее."""
+    user_id = str(user_id) if user_id is not None else None
+    if DKP_STORAGE == "sqlite":
+        return await run_io(db_balances_at, timestamp, user_id)
+    async with dkp_log_lock:
+        return await run_io(read_balances_at, timestamp, user_id)
+
+async def maybe_write_checkpoint(entry_count):
+    """Пишет контрольную точку, если после прошлой набралось DKP_CHECKPOINT_EVENTS записей
+    или прошло DKP_CHECKPOINT_INTERVAL секунд. Вызывается писателем под dkp_lock."""
+    checkpoint_state["events"] += entry_count
+    now = int(time.time())
+    if not checkpoint_state["events"]:
+        return
+    if checkpoint_state["events"] < DKP_CHECKPOINT_EVENTS and now - checkpoint_state["timestamp"] < DKP_CHECKPOINT_INTERVAL:
+        return
+    if dkp_log_backlog:
+        return  # Точка должна совпадать с концом лога - ждем, пока недописанные записи попадут в него
+    balances = {user_id: user_data["dkp"] for user_id, user_data in dkp_data.items()}
+    if DKP_STORAGE == "sqlite":
+        await run_io(db_write_checkpoint, now, balances)
+    else:
+        async with dkp_log_lock:
+            await run_io(write_dkp_checkpoint, now, balances)
+    checkpoint_state["timestamp"] = now
+    checkpoint_state["events"] = 0
+
+# Все изменения DKP идут через очередь единственного писателя: он применяет их пачкой
+# и сохраняет одной записью на диск (group commit). Пока идет запись, новые изменения копятся
+# в очереди; LEDGER_COMMIT_INTERVAL - дополнительное ожидание перед записью пачки (секунды)
+LEDGER_COMMIT_INTERVAL = float(os.environ.get('LEDGER_COMMIT_INTERVAL', 0))
+ledger_queue = asyncio.Queue()
+ledger_stats = {"commits": 0, "mutations": 0, "max_batch": 0}
+ledger_txn_ids = itertools.count(time.time_ns())
+
+def submit_ledger_mutation(mutation):
+    """Ставит изменение в очередь писателя.
+
+    mutation(balance_of) возвращает (balances, entries): новые балансы {user_id: {...}}
+    и записи лога. balance_of(user_id, display_name) - копия текущего баланса с учетом
+    изменений, стоящих в пачке раньше. Возвращает future, который завершается
+    (новыми балансами), когда изменение записано на диск."""
+    future = asyncio.get_running_loop().create_future()
+    ledger_queue.put_nowait((mutation, future))
+    return future
+
+async def ledger_writer():
+    while True:
+        batch = [await ledger_queue.get()]
+        # Собираем все, что пришло за тот же тик, и сохраняем одной записью
+        await asyncio.sleep(LEDGER_COMMIT_INTERVAL)
+        while not ledger_queue.empty():
+            batch.append(ledger_queue.get_nowait())
+        try:
+            await commit_ledger_batch(batch)
+        except Exception as e:
+            print(f"[ERROR] Не удалось сохранить изменения DKP: {e}")
+        finally:
+            for _ in batch:
+                ledger_queue.task_done()
+
+async def commit_ledger_batch(batch):
+    pending = {}
+
+    def balance_of(user_id, display_name=None):
+        user_data = pending.get(user_id) or dkp_data.get(user_id) or {"display_name": display_name, "dkp": 0}
+        return dict(user_data)
+
+    # Считаем новые балансы на копиях, память меняем только после записи на диск
+    records = []
+    accepted = []
+    for mutation, future in batch:
+        try:
+            balances, entries = mutation(balance_of)
+        except Exception as e:
+            future.set_exception(e)
+            continue
+        pending.update(balances)
+        txn = next(ledger_txn_ids)
+        for entry in entries:
+            entry["txn"] = txn
+        records.append({"txn": txn, "balances": balances, "entries": entries})
+        accepted.append((future, balances))
+    if not records:
+        return
+    entries = [entry for record in records for entry in record["entries"]]
 
-    except Exception as e:
-        print(f"[ERROR] Ошибка при записи в dkp_log.json: {e}")
+    async with dkp_lock:
+        try:
+            if DKP_STORAGE == "sqlite":
+                await run_io(db_apply_transaction, pending, entries)
+            else:
+                await run_io(append_dkp_wal, records)
+        except Exception as e:
+            for future, _ in accepted:
+                if not future.done():
+                    future.set_exception(e)
+            raise
 
-async def add_dkp(users, amount):
+        # Изменения уже сохранены (журнал или база) - ошибки дальше их не отменяют,
+        # поэтому ожидающие получают результат в любом случае и не держат блокировки участников
+        try:
+            dkp_data.update(pending)
+            for user_id, user_data in pending.items():
+                leaderboard.update(user_id, user_data["dkp"])
+            if DKP_STORAGE != "sqlite":
+                await save_dkp_data(dkp_data)
+                if entries:
+                    try:
+                        await append_dkp_log_entries(entries)
+                    except Exception as e:
+                        print(f"[ERROR] Ошибка при записи в {DKP_EVENTS_FILE}, записи допишутся позже из журнала: {e}")
+            try:
+                await maybe_write_checkpoint(len(entries))
+            except Exception as e:
+                # Без точки запрос баланса на дату просто доиграет больше лога
+                print(f"[ERROR] Ошибка при записи контрольной точки DKP: {e}")
+        finally:
+            ledger_stats["commits"] += 1
+            ledger_stats["mutations"] += len(records)
+            ledger_stats["max_batch"] = max(ledger_stats["max_batch"], len(records))
+            for future, balances in accepted:
+                if not future.done():
+                    future.set_result(balances)
+
+def dkp_mutation(changes, log=True):
+    """Изменение для очереди писателя. changes - список (user, amount, action, description):
+    action "added" прибавляет amount, остальные - вычитают (баланс не уходит ниже 0).
+    Вызывающий должен держать lock_members этих пользователей."""
+    timestamp = int(time.time())
+
+    def mutation(balance_of):
+        balances = {}
+        entries = []
+        for user, amount, action, description in changes:
+            user_id = str(user.id)
+            display_name = getattr(user, "display_name", None)
+            user_data = balances.get(user_id) or balance_of(user_id, display_name)
+            if action == "added":
+                user_data["dkp"] += amount
+            else:
+                user_data["dkp"] = max(0, user_data["dkp"] - amount)
+            balances[user_id] = user_data
+            if log:
+                entries.append({
+                    "user_id": user_id,
+                    "display_name": display_name or user_data.get("display_name"),
+                    "timestamp": timestamp,
+                    "action": action.capitalize(),
+                    "amount": amount,
+                    "description": description,
+                    "balance": user_data["dkp"]
+                })
+        return balances, entries
+
+    return mutation
+
+async def apply_dkp_transaction(users, amount, action, description="", log=True):
+    """Меняет DKP нескольким пользователям и пишет все записи лога за один шаг сохранения.
+
+    Берет блокировки всех участников (в фиксированном порядке) и держит их, пока
+    изменение не сохранено: изменения разных участников идут параллельно, одного - по очереди.
+    JSON: транзакция одной строкой попадает в dkp_data.wal (fsync) - после падения
+    она либо доигрывается целиком при старте, либо отбрасывается целиком.
+    SQLite: балансы и записи лога пишутся в одной транзакции базы.
+    Возвращает новые балансы, когда изменения сохранены на диск."""
+    return await apply_dkp_changes([(user, amount, action, description) for user in users], log)
+
+async def apply_dkp_changes(changes, log=True):
+    """Как apply_dkp_transaction, но у каждого изменения своя сумма и описание:
+    changes - список (user, amount, action, description). Одна транзакция на весь список."""
+    async with lock_members(user.id for user, *_ in changes):
+        return await submit_ledger_mutation(dkp_mutation(changes, log))
+
+async def add_dkp(users, amount, description=""):
     """Добавляет DKP сразу нескольким пользователям."""
-    dkp_data = await load_dkp_data()
-    updated_users = []
-
-    for user in users:
-        user_id = str(user.id)
-
-        if user_id not in dkp_data:
-            dkp_data[user_id] = {
-                "display_name": user.display_name,
-                "dkp": 0
-            }
-
-        dkp_data[user_id]["dkp"] += amount
-        updated_users.append(user.display_name)
-
-    await save_dkp_data(dkp_data)
+    await apply_dkp_transaction(users, amount, "added", description)
+    updated_users = [user.display_name for user in users]
 
     print(f"[DKP] Added {amount} DKP to users: {', '.join(updated_users)}")  # Лог в консоль
 
-async def sub_dkp(users, amount):
+async def sub_dkp(users, amount, description=""):
     """Удаляет DKP сразу у нескольких пользователей."""
-    dkp_data = await load_dkp_data()
-    updated_users = []
-
-    for user in users:
-        user_id = str(user.id)
-
-        if user_id not in dkp_data:
-            dkp_data[user_id] = {
-                "display_name": user.display_name,
-                "dkp": 0
-            }
-
-        dkp_data[user_id]["dkp"] = max(0, dkp_data[user_id]["dkp"] - amount)
-        updated_users.append(user.display_name)
-
-    await save_dkp_data(dkp_data)
+    await apply_dkp_transaction(users, amount, "removed", description)
+    updated_users = [user.display_name for user in users]
 
     print(f"[DKP] Removed {amount} DKP from users: {', '.join(updated_users)}")  # Лог в консоль
 
@@ -823,23 +2636,19 @@ async def sub_dkp(users, amount):
 @commands.has_any_role('Leader')
 async def adddkp(ctx, amount: int, description: str, *users: discord.Member):
     """Adds DKP points to a user."""
-    await add_dkp(users, amount)  # Asynchronous call
+    await add_dkp(users, amount, description)  # Балансы и лог - одной транзакцией
      # Формируем список получателей
     user_names = ", ".join(user.display_name for user in users)
     await ctx.send(f"{user_names} has received {amount} DKP!\nReason: {description}.")
-    for user in users:
-        await log_dkp_change(user, amount, "added", description)
 
 # Command to subtract DKP points
 @bot.command()
 @commands.has_any_role('Leader')
 async def subdkp(ctx, amount: int, description: str, *users: discord.Member):
     """Removes DKP points from a user."""
-    await sub_dkp(users, amount)  # Asynchronous call
+    await sub_dkp(users, amount, description)  # Балансы и лог - одной транзакцией
     user_names = ", ".join(user.display_name for user in users)
     await ctx.send(f"{user_names} has lost {amount} DKP!\nReason: {description}.")
-    for user in users:
-        await log_dkp_change(user, amount, "removed", description)
 
 # Command to checking DKP points
 @bot.tree.command(name="mydkp", description="Shows your DKP points")
@@ -869,28 +2678,43 @@ async def dkp(interaction: discord.Interaction, user: discord.Member):
 @bot.tree.command(name="topdkp", description="Shows top10 users")
 async def topdkp(interaction: discord.Interaction):
     """Displays the top users with the highest DKP points."""
-    dkp_data = await load_dkp_data()
-
-    if not dkp_data:
+    if not leaderboard:
         await interaction.response.send_message("No DKP data available.")
         return
 
-    # Sort users by DKP points (descending order)
-    top_users = sorted(dkp_data.items(), key=lambda x: x[1]["dkp"], reverse=True)
+    # Топ берем из готового рейтинга, без сортировки всей базы
+    top_users = leaderboard.top(10)
 
     # Create a message with the top 10 users
     top_message = "**🏆 Top DKP Players:**\n"
-    for idx, (user_id, user_data) in enumerate(top_users[:10], 1):
-        try:
-            user = await interaction.client.fetch_user(int(user_id))  # ✅ Получаем пользователя правильно
-            guild_user = interaction.guild.get_member(user.id)  # ✅ Теперь получаем имя в гильдии
-            display_name = guild_user.display_name if guild_user else user.name
-            top_message += f"{idx}. {display_name} — {user_data['dkp']} DKP\n"
-        except:
-            top_message += f"{idx}. Unknown user (ID {user_id}) — {user_data['dkp']} DKP\n"
+    users = await resolve_users(interaction.guild, [user_id for user_id, _ in top_users])
+    for idx, (user_id, dkp_points) in enumerate(top_users, 1):
+        user = users[int(user_id)]
+        if user:
+            top_message += f"{idx}. {member_name(user)} — {dkp_points} DKP\n"
+        else:
+            top_message += f"{idx}. Unknown user (ID {user_id}) — {dkp_points} DKP\n"
 
     await interaction.response.send_message(top_message)
 
+#Show rank of the user
+@bot.tree.command(name="myrank", description="Shows your place in the DKP ranking")
+async def myrank(interaction: discord.Interaction):
+    """Shows the user's place in the DKP ranking and percentile."""
+    user_id = str(interaction.user.id)
+    rank = leaderboard.rank(user_id)
+    if rank is None:
+        await interaction.response.send_message("You are not in the DKP database.", ephemeral=True)
+        return
+
+    total = len(leaderboard)
+    dkp_points = dkp_data[user_id]["dkp"]
+    await interaction.response.send_message(
+        f"{interaction.user.display_name}: place **{rank}** of {total} with {dkp_points} DKP "
+        f"(top {rank / total * 100:.1f}%, ahead of {(total - rank) / total * 100:.1f}% of members).",
+        ephemeral=True
+    )
+
 #Show DKP of all members
 @bot.tree.command(name="alldkp", description="Shows all users") 
 async def alldkp(interaction: discord.Interaction):
@@ -903,27 +2727,14 @@ async def alldkp(interaction: discord.Interaction):
     
     await interaction.response.defer()  # ✅ Сообщаем Discord, что команда обрабатывается
 
-    dkp_data = await load_dkp_data()
-    
-    if not dkp_data:
-        await interaction.followup.send("No users with DKP found.")  # ✅ Используем followup
+    if not leaderboard:
+        send_message(interaction.followup, "No users with DKP found.", priority=OUTBOX_HIGH)  # ✅ Используем followup
         return
 
-    # Sort by DKP points in descending order
-    all_users = sorted(dkp_data.items(), key=lambda x: x[1]["dkp"], reverse=True)
-
-    # Create a message with DKP for each user
-    all_dkp_message = "**📜 All Players and Their DKP:**\n"
-    for user_id, user_data in all_users:
-        try:
-            user = await interaction.client.fetch_user(int(user_id))
-            guild_user = interaction.guild.get_member(user.id)
-            display_name = guild_user.display_name if guild_user else user.name
-            all_dkp_message += f"{display_name}: {user_data['dkp']} DKP\n"
-        except:
-            all_dkp_message += f"Unknown user (ID {user_id}): {user_data['dkp']} DKP\n"
-
-    await interaction.followup.send(all_dkp_message)  # ✅ Используем followup для отправки ответа
+    # Показываем первую страницу, остальные листаются кнопками
+    embed, page, page_count = await dkp_page(interaction.guild, 0, 0)
+    view = pager_view("dkp", 0, page, page_count)
+    send_message(interaction.followup, embed=embed, view=view or discord.utils.MISSING, priority=OUTBOX_HIGH)
 
 #Delete user from Data
 @bot.command()
@@ -933,12 +2744,14 @@ async def duser(ctx, user: discord.Member):
     dkp_data = await load_dkp_data()
     user_id = str(user.id)
 
-    if user_id not in dkp_data:
-        await ctx.send(f"{user.mention} is not in the DKP database.")
-        return
+    async with lock_members([user.id]):
+        if user_id not in dkp_data:
+            await ctx.send(f"{user.mention} is not in the DKP database.")
+            return
 
-    del dkp_data[user_id]  # Удаляем пользователя из базы
-    await save_dkp_data(dkp_data)
+        del dkp_data[user_id]  # Удаляем пользователя из базы
+        leaderboard.remove(user_id)
+        await save_dkp_data(dkp_data)
 
     await ctx.send(f"{user.mention} has been removed from the DKP database.")
 
@@ -949,7 +2762,7 @@ async def help(interaction: discord.Interaction):
     embed = discord.Embed(title="Help Menu", description="List of available commands", color=discord.Color.blue())
 
     embed.add_field(name="🛒 Auctions", value="/mybids - All users active bids\n/bid <auctionID> <amount> - Place a bid\n/bids <auctionID> - All members bids\n/aucs - list of all active auctions\n/dbid <auctionID> - Delete your bid", inline=False)
-    embed.add_field(name="📊 DKP System", value="/mydkp - Show DKP/n/dkp <user> - Show users DKP\n/alldkp - list of all members points\n/topdkp - list of top 10 members", inline=False) 
+    embed.add_field(name="📊 DKP System", value="/mydkp - Show DKP/n/dkp <user> - Show users DKP\n/alldkp - list of all members points\n/topdkp - list of top 10 members\n/myrank - your place in the ranking", inline=False) 
     await interaction.response.send_message(embed=embed, ephemeral=True)  # ephemeral=True – только для пользователя
 
 #Open admin help tab 
@@ -957,44 +2770,62 @@ async def help(interaction: discord.Interaction):
 async def ahelp(ctx):
     embed = discord.Embed(title="Help Menu", description="List of available commands", color=discord.Color.blue())
 
-    embed.add_field(name="🛠 Admin Commands", value="!upload_git <> - upload reserv to git\n!dload_git - download from git reserv to git main!\n dload_loc - download from git reserv to local\n!duser <user> - Removes a user\n!subdkp <amount> <reason> <users> - Removes DKP points\n!adddkp <amount> <reason> <users> - Adds DKP points\n!fendauc <auction> - End auction manualy\n!sauc <name> <item> <trait> <duration> - Start an auction\n!updm_names - update all members display names in data\n!add_members - add all new members", inline=False)
+    embed.add_field(name="🛠 Admin Commands", value="!upload_git <> - upload reserv to git\n!dload_git - download from git reserv to git main!\n dload_loc - download from git reserv to local\n!duser <user> - Removes a user\n!subdkp <amount> <reason> <users> - Removes DKP points\n!adddkp <amount> <reason> <users> - Adds DKP points\n!fendauc <auction ...> - End auctions manualy\n!afind <boss or item> - past auctions for a boss or item\n!alist [from] [to] - auctions for a period (default last 7 days)\n!aucstats - auction scheduler stats\n!iostats - storage I/O stats\n!sauc <name> <item> <trait> <duration> - Start an auction\n!bsauc <name> <duration> + 'item | trait' lines - Start auctions for all drops\n!updm_names - update all members display names in data\n!add_members - add all new members\n!dkpat [user] <YYYY-MM-DD> [HH:MM] - DKP balances at a date\n!compact_log - compact the DKP log\n!migrate_sqlite - import JSON data into SQLite", inline=False)
 
     await ctx.send(embed=embed)
 
 #Open users log
 @bot.command()
 @commands.has_any_role('Admin', 'Moderator', 'Leader')
-async def log(ctx, user: discord.Member):
-    """Shows the DKP log history for a user."""
-    log_file = "dkp_log.json"
+async def log(ctx, user: discord.Member, page: int = 1, date_from: str = None, date_to: str = None):
+    """Shows the DKP log history for a user: !log @user [page] [from YYYY-MM-DD] [to YYYY-MM-DD]."""
     user_id = str(user.id)
 
     try:
+        # Границы периода в epoch - по ним бинарный поиск в индексе времени
+        try:
+            start, end = parse_date_range(date_from, date_to)
+        except ValueError:
+            await ctx.send("Usage: !log @user [page] [from YYYY-MM-DD] [to YYYY-MM-DD]")
+            return
+        page = max(page, 1)
+
+        if DKP_STORAGE == "sqlite":
+            logs, total = await run_io(db_user_logs, user_id, DKP_LOG_PAGE_SIZE, (page - 1) * DKP_LOG_PAGE_SIZE, start, end)
+
         # Проверяем существование файла
-        if not os.path.exists(log_file):
+        elif not os.path.exists(DKP_EVENTS_FILE):
             await ctx.send("No DKP log file found.")
             return
 
-        # Загружаем логи
-        async with aiofiles.open(log_file, mode="r") as f:
-            content = await f.read()
-            dkp_logs = json.loads(content) if content.strip() else {}
+        elif page == 1 and start is None and end is None:
+            # Последние записи уже в памяти - файл не читаем
+            logs = list(dkp_log_index.recent.get(user_id, []))
+            total = len(dkp_log_index.offsets.get(user_id, []))
+
+        else:
+            # Старые страницы и периоды читаем по индексу смещений, только нужные строки
+            offsets, total = dkp_log_index.page(user_id, page, start, end)
+            logs = await run_io(read_dkp_log_entries, offsets)
 
         # Проверяем, есть ли логи для данного пользователя
-        if user_id not in dkp_logs or "logs" not in dkp_logs[user_id]:
+        if not logs:
             await ctx.send(f"No logs found for {user.mention}.")
             return
 
         # Преобразуем записи логов в нужный формат
         formatted_logs = [
-            f"{entry['timestamp']}, '{entry['action']}', {entry['amount']}, '{entry['description']}'"
-            for entry in dkp_logs[user_id]["logs"]
+            f"{format_timestamp(entry['timestamp'])}, '{entry['action']}', {entry['amount']}, '{entry['description']}'"
+            for entry in logs
         ]
+        log_text = "\n".join(formatted_logs)
+        pages = (total + DKP_LOG_PAGE_SIZE - 1) // DKP_LOG_PAGE_SIZE
 
-        # Ограничиваем количество записей (например, до 10)
-        log_text = "\n".join(formatted_logs[-10:])
-
-        await ctx.send(f"**DKP Log for {ctx.guild.get_member(user.id).display_name}:**\n```{log_text}```")
+        header = f"**DKP Log for {user.display_name} (page {page}/{pages}, {total} entries)"
+        if start is not None or end is not None:
+            totals = await user_dkp_totals(user_id, start, end)
+            header += f", earned {totals['earned']} / spent {totals['spent']} DKP"
+        await ctx.send(f"{header}:**\n```{log_text}```")
 
     except Exception as e:
         await ctx.send(f"Error fetching logs: {e}")
@@ -1009,24 +2840,16 @@ async def log_error(ctx, error):
 @commands.has_any_role('Admin', 'Moderator', 'Leader')
 async def alog(ctx, auction_id: int):
     """Shows the auction log history for a given auction ID."""
-    auction_file = "auc_log.json"  # Укажи правильное название файла
+    auction_file = AUC_LOG_FILE
 
     try:
         # Проверяем существование файла
-        if not os.path.exists(auction_file):
+        if DKP_STORAGE != "sqlite" and auction_history is None and not os.path.exists(auction_file):
             await ctx.send("No auction log file found.")
             return
 
-        # Загружаем логи
-        async with aiofiles.open(auction_file, mode="r") as f:
-            content = await f.read()
-            auctions_data = json.loads(content) if content.strip() else {}
-
-        # Ищем нужный аукцион по ID
-        auction = next(
-            (auc for auc in auctions_data["auctions"].values() if auc["id"] == auction_id),
-            None
-        )
+        # Ищем нужный аукцион по ID (индекс в памяти)
+        auction = await run_io(find_auction_record, auction_id)
 
         if not auction:
             await ctx.send(f"No auction logs found for ID {auction_id}.")
@@ -1037,8 +2860,8 @@ async def alog(ctx, auction_id: int):
         log_text += f"**Name:** {auction['name']}\n"
         log_text += f"**Item:** {auction['item']}\n"
         log_text += f"**Description:** {auction['description']}\n"
-        log_text += f"**Created At:** {auction['created_at']}\n"
-        log_text += f"**Ended At:** {auction['date_of_end']}\n"
+        log_text += f"**Created At:** {format_timestamp(auction['created_at'])}\n"
+        log_text += f"**Ended At:** {format_timestamp(auction['date_of_end'])}\n"
 
         if auction["top_3_bids"]:
             log_text += "**Top 3 Bids:**\n"
@@ -1057,12 +2880,222 @@ async def alog_error(ctx, error):
     if isinstance(error, commands.CommandOnCooldown):
         await ctx.send(f"{ctx.author.mention}, wait {error.retry_after:.1f} s before next command reuse!")
 
+#Find aucs by boss or item
+@bot.command()
+@commands.has_any_role('Admin', 'Moderator', 'Leader')
+async def afind(ctx, *, name: str):
+    """Lists past auctions for a boss or an item."""
+    records = await run_io(find_auction_records, name)
+
+    if not records:
+        await ctx.send(f"No auctions found for '{name}'.")
+        return
+
+    lines = []
+    for auction in records[-15:]:  # Последние 15 аукционов
+        winner = auction["top_3_bids"][0] if auction["top_3_bids"] else None
+        result = f"<@{winner['user_id']}> - {winner['amount']} DKP" if winner else "no bids"
+        lines.append(f"**{auction['id']}** {auction['name']}: {auction['item']} {format_timestamp(auction['date_of_end'])} - {result}")
+
+    await ctx.send(f"Auctions for **{name}** ({len(records)} total, last {len(lines)}):\n" + "\n".join(lines))
+
+# Баланс DKP на дату
+@bot.command()
+@commands.has_any_role('Leader')
+async def dkpat(ctx, user: typing.Optional[discord.Member], date: str, time_of_day: str = "23:59:59"):
+    """Shows DKP balances as they were at a moment: !dkpat [@user] YYYY-MM-DD [HH:MM[:SS]]."""
+    try:
+        moment = datetime.datetime.fromisoformat(f"{date} {time_of_day}")
+    except ValueError:
+        await ctx.send("Usage: !dkpat [@user] YYYY-MM-DD [HH:MM[:SS]]")
+        return
+    timestamp = int(time.mktime(moment.timetuple()))
+
+    balances = await dkp_balances_at(timestamp, user.id if user else None)
+    when = format_timestamp(timestamp)
+    estimate = ""
+    if await dkp_checkpoint_before(timestamp) is None:
+        estimate = ("\n⚠️ No balance checkpoint before this date: this is an estimate replayed from an empty ledger "
+                    "and misses changes that were never logged.")
+    if user:
+        await ctx.send(f"**{user.display_name}** had **{balances.get(str(user.id), 0)} DKP** at {when}.{estimate}")
+        return
+
+    lines = []
+    for user_id, dkp in sorted(balances.items(), key=lambda item: -item[1]):
+        if dkp:
+            member = ctx.guild.get_member(int(user_id))
+            name = member.display_name if member else (dkp_data.get(user_id) or {}).get("display_name") or user_id
+            lines.append(f"{name}: {dkp} DKP")
+    if not lines:
+        await ctx.send(f"No DKP balances at {when}.")
+        return
+    await ctx.send(f"**DKP balances at {when}:**{estimate}")
+    for text in chunk_lines(lines):
+        await ctx.send(text)
+
+#List aucs for a period
+@bot.command()
+@commands.has_any_role('Admin', 'Moderator', 'Leader')
+async def alist(ctx, date_from: str = None, date_to: str = None):
+    """Lists auctions created in a period: !alist [from YYYY-MM-DD] [to YYYY-MM-DD] (default - last 7 days)."""
+    try:
+        start, end = parse_date_range(date_from, date_to)
+    except ValueError:
+        await ctx.send("Usage: !alist [from YYYY-MM-DD] [to YYYY-MM-DD]")
+        return
+    if start is None:
+        start = int(time.time()) - 7 * 86400
+    if end is None:
+        end = int(time.time())
+
+    records = await run_io(find_auctions_between, start, end)
+    if not records:
+        await ctx.send("No auctions found for this period.")
+        return
+
+    lines = []
+    for auction in records:
+        winner = auction["top_3_bids"][0] if auction["top_3_bids"] else None
+        result = f"<@{winner['user_id']}> - {winner['amount']} DKP" if winner else "no bids"
+        lines.append(f"**{auction['id']}** {format_timestamp(auction['created_at'])} {auction['name']}: {auction['item']} - {result}")
+
+    pages = chunk_lines(lines)
+    await ctx.send(f"Auctions from {format_timestamp(start)} to {format_timestamp(end)} ({len(records)} total):")
+    for text in pages[:5]:  # Не больше 5 сообщений на команду
+        await ctx.send(text)
+
+# Статистика ввода-вывода
+@bot.command()
+@commands.has_any_role('Leader')
+async def iostats(ctx):
+    """Shows disk I/O timings and how long the event loop has been blocked."""
+    calls = io_stats["calls"]
+    avg_io = io_stats["io_total"] / calls if calls else 0.0
+    await ctx.send(
+        f"**💾 Storage I/O:**\n"
+        f"I/O calls: {calls} | avg {avg_io * 1000:.1f} ms, max {io_stats['io_max'] * 1000:.1f} ms (off the event loop)\n"
+        f"Snapshot copies on loop: max {io_stats['snapshot_max'] * 1000:.2f} ms\n"
+        f"Event loop blocked: last {io_stats['loop_lag_last'] * 1000:.1f} ms, max {io_stats['loop_lag_max'] * 1000:.1f} ms\n"
+        f"DKP group commits: {ledger_stats['commits']} for {ledger_stats['mutations']} changes "
+        f"(max batch {ledger_stats['max_batch']}, queued now {ledger_queue.qsize()})\n"
+        f"Outbox: {outbox.depth()} queued in {len(outbox.queues)} channels, sent {outbox.stats['sent']}, "
+        f"retries {outbox.stats['retries']}, failed {outbox.stats['failed']}, "
+        f"coalesced {outbox.stats['coalesced']}, dropped {outbox.stats['dropped']}"
+    )
+
+# Сжатие лога DKP
+@bot.command()
+@commands.has_any_role('Leader')
+async def compact_log(ctx):
+    """Rewrites dkp_log.jsonl without damaged records and rebuilds its index."""
+    if DKP_STORAGE == "sqlite":
+        await ctx.send("❌ The DKP log is stored in SQLite, nothing to compact.")
+        return
+
+    async with dkp_log_lock:
+        try:
+            count = await run_io(compact_dkp_log)
+        except Exception as e:
+            await ctx.send(f"Error compacting DKP log: {e}")
+            return
+
+    await ctx.send(f"✅ DKP log compacted: {count} entries kept.")
+
+# Одноразовый перенос JSON-файлов в SQLite
+@bot.command()
+@commands.has_any_role('Leader')
+async def migrate_sqlite(ctx):
+    """Imports dkp_data.json, dkp_log.json and auc_log.json into the SQLite database."""
+    if DKP_STORAGE == "sqlite":
+        await ctx.send("❌ The bot is already running on SQLite, migration would overwrite live data.")
+        return
+
+    # Сначала сбрасываем на диск DKP из памяти, чтобы перенести актуальные балансы
+    await flush_dkp_data()
+    try:
+        counts = await run_io(migrate_json_to_sqlite)
+    except Exception as e:
+        await ctx.send(f"Error migrating to SQLite: {e}")
+        return
+
+    await ctx.send(
+        f"✅ Migrated to `{DKP_DB_FILE}`: {counts['members']} members, {counts['ledger']} log entries, "
+        f"{counts['auctions']} auctions, {counts['bids']} bids.\n"
+        f"Set `DKP_STORAGE=sqlite` and restart the bot to use it."
+    )
+
+def replace_data_files(contents):
+    """Записывает файлы данных из contents {имя файла: текст} и читает их заново.
+
+    Выполняется в потоке ввода-вывода. Балансы и индекс лога читаются на loop, поэтому здесь
+    их не трогаем - возвращаем новое состояние {"dkp": ..., "log_index": ..., "last_auction_id": ...},
+    его подменяет restore_data_files. История аукционов живет только в потоке ввода-вывода
+    и подменяется здесь же, чтобы ни одна запись в auc_log.json не прошла по старой истории."""
+    global auction_history
+    for file_name, content in contents.items():
+        write_file_atomic(file_name, content)
+    state = {}
+    if DKP_FILE in contents:
+        state["dkp"] = read_dkp_file()
+        # Журнал относится к замененным балансам - при старте он не должен доигрываться поверх
+        if os.path.exists(DKP_WAL_FILE):
+            os.remove(DKP_WAL_FILE)
+    if DKP_EVENTS_FILE in contents or DKP_LOG_FILE in contents:
+        # Старые точки к восстановленному логу не относятся; удаляем их до перезаписи лога,
+        # чтобы перевод меток времени не пересчитывал их
+        if os.path.exists(DKP_CHECKPOINTS_FILE):
+            os.remove(DKP_CHECKPOINTS_FILE)
+        if DKP_EVENTS_FILE not in contents:
+            # Старый резерв: лог в формате dkp_log.json переводим в dkp_log.jsonl
+            convert_dkp_log_to_jsonl()
+        log_index = build_dkp_log_index()
+        if log_index.legacy:
+            migrate_dkp_log_timestamps()
+            log_index = build_dkp_log_index()
+        state["log_index"] = log_index
+    if AUC_LOG_FILE in contents:
+        history = AuctionHistory(read_auction_log())
+        if history.migrated:
+            write_auction_log(history.log)
+        auction_history = history
+        state["last_auction_id"] = int(history.log["last_id"])
+    return state
+
+async def restore_data_files(contents):
+    """Заменяет файлы данных работающего бота (восстановление из резерва).
+
+    Берет блокировки всех участников и дожидается очереди писателя, чтобы ни одно
+    изменение DKP не шло во время замены. Файлы пишутся и читаются в потоке ввода-вывода,
+    а состояние в памяти подменяется на loop одним шагом, без await - обработчики
+    не видят его наполовину замененным."""
+    global dkp_dirty, dkp_log_index, last_auction_id
+    async with lock_members(range(DKP_LOCK_STRIPES)):
+        await ledger_queue.join()
+        async with dkp_lock, dkp_log_lock:
+            state = await run_io(replace_data_files, contents)
+            if "dkp" in state:
+                dkp_data.clear()
+                dkp_data.update(state["dkp"])
+                dkp_dirty = False
+                leaderboard.rebuild(dkp_data)
+            if "log_index" in state:
+                dkp_log_index = state["log_index"]
+                dkp_log_backlog.clear()
+                dkp_checkpoints.clear()
+                checkpoint_state["timestamp"] = 0
+            if "last_auction_id" in state:
+                # ID уже выданных активным аукционам не должны повториться
+                last_auction_id = max(last_auction_id, state["last_auction_id"])
+
 # Функция для загрузки файлов на GitHub
 @bot.command()
 @commands.has_any_role('Admin', 'Moderator', 'Leader')
 async def upload_git(ctx, github_token: str, repo_name: str, *files):
     """Загружает файлы в папку на GitHub."""
-    
+    # Балансы живут в памяти - сначала сбрасываем их на диск, чтобы в резерв попали свежие
+    await flush_dkp_data()
+
     # Авторизация через токен
     g = Github(github_token)
     repo = g.get_repo(repo_name)
@@ -1090,12 +3123,24 @@ async def upload_git(ctx, github_token: str, repo_name: str, *files):
             repo.create_file(f"reserv/{file_name}", f"Upload {file_name}", content)
             await ctx.send(f"Uploaded {file_name} to repository.")
 
+def get_reserv_file(repo, file_name):
+    """Возвращает (имя файла, содержимое) из папки reserv. Резервы, сделанные до перехода
+    на dkp_log.jsonl, хранят лог в dkp_log.json - берем его, если нового файла нет."""
+    try:
+        file_content = repo.get_contents(f"reserv/{file_name}")
+    except UnknownObjectException:
+        if file_name != DKP_EVENTS_FILE:
+            raise
+        file_name = DKP_LOG_FILE
+        file_content = repo.get_contents(f"reserv/{file_name}")
+    return file_name, file_content.decoded_content.decode("utf-8")
+
 # Функция для загрузки файлов из GitHub в GitHub резерв
 @bot.command()
 @commands.has_any_role('Admin', 'Moderator', 'Leader')
 async def dload_git(ctx, github_token: str, repo_name: str, files=None):
     if files is None:
-        files = ["dkp_log.json", "auc_log.json", "dkp_data.json"]  # Список файлов по умолчанию
+        files = ["dkp_log.jsonl", "auc_log.json", "dkp_data.json"]  # Список файлов по умолчанию
     
     # Авторизация через токен
     g = Github(github_token)
@@ -1105,8 +3150,7 @@ async def dload_git(ctx, github_token: str, repo_name: str, files=None):
     for file_name in files:
         try:
             # Получаем содержимое файла из папки 'reserv'
-            file_content = repo.get_contents(f"reserv/{file_name}")
-            content = file_content.decoded_content.decode("utf-8")
+            file_name, content = get_reserv_file(repo, file_name)
 
             # Проверяем, существует ли файл в корневой папке репозитория
             try:
@@ -1128,7 +3172,7 @@ async def dload_git(ctx, github_token: str, repo_name: str, files=None):
 @commands.has_any_role('Admin', 'Moderator', 'Leader')
 async def dload_loc(ctx, github_token: str, repo_name: str, files=None, local_folder=None):
     if files is None:
-        files = ["dkp_log.json", "auc_log.json", "dkp_data.json"]  # Список файлов по умолчанию
+        files = ["dkp_log.jsonl", "auc_log.json", "dkp_data.json"]  # Список файлов по умолчанию
     
     # Папка для сохранения файлов (если не указана, сохраняем в текущей папке проекта)
     if local_folder is None:
@@ -1142,25 +3186,39 @@ async def dload_loc(ctx, github_token: str, repo_name: str, files=None, local_fo
     g = Github(github_token)
     repo = g.get_repo(repo_name)
     
+    # Файлы данных работающего бота нельзя просто перезаписать: балансы, индекс лога и история
+    # аукционов живут в памяти, и следующий сброс затер бы восстановленные файлы
+    live_data = DKP_STORAGE == "json" and os.path.abspath(local_folder) == os.getcwd()
+    downloaded = {}
+
     # Проходим по каждому файлу и загружаем его из папки reserv
     for file_name in files:
         try:
             # Получаем содержимое файла из папки 'reserv'
-            file_content = repo.get_contents(f"reserv/{file_name}")
-            content = file_content.decoded_content.decode("utf-8")
-            
+            file_name, content = get_reserv_file(repo, file_name)
+
+            if live_data and file_name in (DKP_FILE, DKP_EVENTS_FILE, DKP_LOG_FILE, AUC_LOG_FILE):
+                downloaded[file_name] = content
+                continue
+
             # Путь для сохранения файла в локальной папке
             local_file_path = os.path.join(local_folder, file_name)
 
             # Сохраняем файл в локальной папке
-            with open(local_file_path, "w") as local_file:
-                local_file.write(content)
+            write_file_atomic(local_file_path, content)
 
             await ctx.send(f"Successfully downloaded {file_name} to the local folder.")
         
         except Exception as e:
             await ctx.send(f"Error downloading {file_name} from 'reserv' to the local folder: {e}")
 
+    if downloaded:
+        try:
+            await restore_data_files(downloaded)
+            await ctx.send(f"Successfully restored {', '.join(downloaded)} and reloaded them into the bot.")
+        except Exception as e:
+            await ctx.send(f"Error restoring {', '.join(downloaded)}: {e}")
+
 
 
 @bot.event
@@ -1176,8 +3234,6 @@ async def clearsync(ctx):
     await ctx.send("Cleared and resynced commands!")
 
 
-# Загружаем данные при старте
-dkp_data = load_dkp_data()
-
 # Запуск бота
-bot.run(DISCORD_TOKEN)
+if __name__ == "__main__":
+    bot.run(DISCORD_TOKEN)
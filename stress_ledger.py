@@ -0,0 +1,135 @@
+"""Стресс-тест DKP: тысячи параллельных изменений, затем сверка итогов.
+
+Два прогона:
+- ledger: параллельные apply_dkp_transaction - итоговые балансы (в памяти и на диске) сходятся с ожидаемыми;
+- holds: ставки (free_dkp + hold_bid, как в /bid) вперемешку со списаниями свободных DKP -
+  блокированные под ставки DKP никогда не превышают баланс. Без lock_members этот прогон падает:
+  ставка успевает прочитать баланс, пока списание ждет записи на диск.
+
+Запуск: python stress_ledger.py [transactions] [members]
+Работает во временной папке - настоящие файлы данных не трогает."""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+os.environ.setdefault("GUILD_ID", "1")
+os.chdir(tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot  # noqa: E402
+
+START_DKP = 1_000_000  # Достаточно, чтобы списания не упирались в 0
+HOLD_START_DKP = 1000  # Мало, чтобы ставки и списания постоянно боролись за одни и те же DKP
+
+
+class Member:
+    def __init__(self, member_id):
+        self.id = member_id
+        self.display_name = f"member{member_id}"
+
+
+def reset_state(members, start_dkp):
+    bot.dkp_log_index = bot.build_dkp_log_index()
+    bot.dkp_data.clear()
+    bot.bid_holds.clear()
+    bot.locked_dkp_totals.clear()
+    for member_id in range(members):
+        bot.dkp_data[str(member_id)] = {"display_name": f"member{member_id}", "dkp": start_dkp}
+
+
+async def stress_ledger(transactions, members):
+    """Параллельные изменения нескольких участников сразу: итоги должны сойтись."""
+    reset_state(members, START_DKP)
+    rnd = random.Random(1)
+    expected = {str(member_id): START_DKP for member_id in range(members)}
+    jobs = []
+    for _ in range(transactions):
+        ids = rnd.sample(range(members), rnd.randint(1, 3))
+        amount = rnd.randint(1, 50)
+        action = rnd.choice(["added", "removed"])
+        for member_id in ids:
+            expected[str(member_id)] += amount if action == "added" else -amount
+        jobs.append(bot.apply_dkp_transaction([Member(member_id) for member_id in ids], amount, action, "stress"))
+
+    await asyncio.wait_for(asyncio.gather(*jobs), timeout=120)
+    await bot.ledger_queue.join()
+    await bot.flush_dkp_data()
+
+    errors = {user_id for user_id, dkp in expected.items() if bot.dkp_data[user_id]["dkp"] != dkp}
+    on_disk = bot.read_dkp_file()
+    errors |= {user_id for user_id, dkp in expected.items() if on_disk[user_id]["dkp"] != dkp}
+    logged = sum(len(offsets) for offsets in bot.dkp_log_index.offsets.values())
+    print(f"ledger: {transactions} transactions, {members} members: {bot.ledger_stats['commits']} commits, "
+          f"max batch {bot.ledger_stats['max_batch']}, {logged} log entries")
+    return [f"wrong balance for member {user_id}" for user_id in sorted(errors)]
+
+
+async def place_hold(member_id, auction_id, amount):
+    # Как /bid: проверка свободных DKP и блокировка под ставку - под блокировкой участника
+    async with bot.lock_members([member_id]):
+        if amount <= bot.free_dkp(member_id):
+            bot.hold_bid(member_id, auction_id, amount)
+    await asyncio.sleep(0)
+    # Часть ставок перебивают - блокировка снимается
+    if auction_id % 3 == 0:
+        bot.release_bid(member_id, auction_id)
+
+
+async def spend_free(member, amount, spent):
+    # Списание только свободных DKP: между проверкой и записью на диск есть await
+    async with bot.lock_members([member.id]):
+        if amount <= bot.free_dkp(member.id):
+            await bot.submit_ledger_mutation(bot.dkp_mutation([(member, amount, "removed", "stress")]))
+            spent[member.id] += amount
+
+
+async def stress_holds(transactions, members):
+    """Ставки и списания одних и тех же участников: заблокированное не должно превышать баланс."""
+    reset_state(members, HOLD_START_DKP)
+    rnd = random.Random(2)
+    spent = {member_id: 0 for member_id in range(members)}
+    jobs = []
+    for auction_id in range(transactions):
+        member_id = rnd.randrange(members)
+        amount = rnd.randint(1, 100)
+        if rnd.random() < 0.5:
+            jobs.append(place_hold(member_id, auction_id, amount))
+        else:
+            jobs.append(spend_free(Member(member_id), amount, spent))
+
+    await asyncio.wait_for(asyncio.gather(*jobs), timeout=120)
+    await bot.ledger_queue.join()
+
+    errors = []
+    for member_id in range(members):
+        dkp = bot.dkp_data[str(member_id)]["dkp"]
+        held = bot.locked_dkp_totals.get(member_id, 0)
+        if dkp != HOLD_START_DKP - spent[member_id]:
+            errors.append(f"member {member_id}: balance {dkp}, expected {HOLD_START_DKP - spent[member_id]}")
+        if held > dkp:
+            errors.append(f"member {member_id}: {held} DKP held for bids with only {dkp} DKP")
+    print(f"holds: {transactions} bids/debits, {members} members, {sum(spent.values())} DKP spent, "
+          f"{sum(bot.locked_dkp_totals.values())} DKP held")
+    return errors
+
+
+async def main(transactions=3000, members=200):
+    writer = asyncio.create_task(bot.ledger_writer())
+    try:
+        errors = await stress_ledger(transactions, members)
+        errors += await stress_holds(transactions, max(1, members // 10))
+    finally:
+        writer.cancel()
+    if errors:
+        print(f"FAIL: {len(errors)} problems")
+        for error in errors[:20]:
+            print(f"  {error}")
+        return 1
+    print("OK: balances match and held DKP never exceed balances")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(*(int(arg) for arg in sys.argv[1:3]))))